@@ -5,17 +5,26 @@ import time
 import re
 import io
 import tempfile
-from litestar import Controller, get, post, put, delete, Request
+from litestar import Controller, get, post, put, delete, Request, Response
 from litestar.response import File, Stream
 from litestar.exceptions import HTTPException
 from starlette import status
 from addict import Dict
+import util
 from models.field import Field
 from models.record import Record
-from models.engine import get_engine, Connection
+from models.engine import get_engine, Connection, db_manager
+from models.executor import db_executor
 from models.database import Database
 from models.table import Table, Grid
-from models.user import User
+from models.grid import grid_results, grid_etag, invalidate_grids
+from models.user import User, invalidate_privileges
+
+
+def media_type(request):
+    """Return MessagePack if accepted by client, else JSON"""
+    accept = request.headers.get('accept', '')
+    return util.MSGPACK if util.MSGPACK in accept else util.JSON
 
 
 class Database_Controller(Controller):
@@ -59,6 +68,10 @@ class Database_Controller(Controller):
                         sql = 'set role ' + role
                         crsr.execute(sql)
                         db_cnxn.commit()
+            if role:
+                # Privileges depend on role
+                invalidate_privileges(engine)
+                invalidate_grids(engine)
 
             user = User(engine, db_cnxn)
             rows = user.databases()
@@ -99,57 +112,135 @@ class Database_Controller(Controller):
 
 
     @get("/database", sync_to_thread=True)
-    def db_info(self, base: str, request: Request, db_cnxn: Connection) -> dict:
+    def db_info(self, base: str, request: Request,
+                db_cnxn: Connection) -> Response:
         cfg = request.app.state.cfg
         engine = get_engine(cfg, base)
         dbo = Database(engine, base, cfg.uid, db_cnxn)
         info = dbo.get_info()
-        return {'data': info}
+        fmt = media_type(request)
+        return Response(content=util.encode({'data': info}, fmt),
+                        media_type=fmt)
 
 
     @get("/table")
     async def get_table(
-        self, base: str, table: str, request: Request, db_cnxn: Connection,
+        self, base: str, table: str, request: Request,
         limit: int = 30, offset: int = 0, schema: str = '', sort: str = '',
-        compressed: bool = False, prim_key: str = '', filter: str = ''
+        compressed: bool = False, prim_key: str = '', filter: str = '',
+        cursor: str = '', columnar: bool = False
+    ) -> Response:
+        cfg = request.app.state.cfg
+
+        # Cached responses are checked before a connection is checked
+        # out, so they don't touch the database. Grids changed by others
+        # than this application may be stale for `grid_ttl` seconds
+        engine = await db_executor.checkout(get_engine, cfg, base)
+        fmt = media_type(request)
+        key = (engine.host, engine.db_name, table, engine.identity, cfg.uid,
+               schema, limit, offset, sort, compressed, prim_key, filter,
+               cursor, columnar, fmt)
+        cached = grid_results.get(key)
+        if cached:
+            etag, body = cached
+            if request.headers.get('if-none-match') == etag:
+                return Response(content=None, status_code=304,
+                                headers={'ETag': etag})
+            return Response(content=body, media_type=fmt,
+                            headers={'ETag': etag})
+
+        def load_grid(db_cnxn):
+            if cfg.system == 'postgresql' and schema:
+                base_path = base + '.' + schema
+            else:
+                base_path = base or schema
+            dbo = Database(engine, base_path, cfg.uid, db_cnxn)
+            tbl = Table(dbo, table)
+            privilege = dbo.user.table_privilege(dbo.schema, table)
+            if privilege.select == 0:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="No access"
+                )
+            grid = Grid(tbl)
+            tbl.limit = limit
+            tbl.offset = offset
+
+            if sort:
+                grid.sort_columns = Dict(json.loads(sort))
+
+            if filter:
+                fltr = urllib.parse.unquote(filter)
+                if fltr.startswith('where '):
+                    where = fltr[6:].split(';')[0]
+                    grid.cond.prep_stmnts.append(where)
+                else:
+                    grid.set_search_cond(fltr)
+
+            grid.compressed = compressed
+            grid.columnar = columnar
+            # Token for keyset pagination, with offset used for display only
+            grid.cursor = cursor or None
+
+            # todo: handle sort
+            pkey_vals = None
+            if prim_key:
+                pkey_vals = json.loads(prim_key)
+
+            return grid.get(pkey_vals)
+
+        async with db_executor.connection(db_manager.get_pool(engine)) as cnxn:
+            data = await db_executor.run(load_grid, cnxn, request=request,
+                                         cnxn=cnxn)
+        body = util.encode({'data': data}, fmt)
+        etag = grid_etag(body)
+        grid_results.set(key, (etag, body))
+        if request.headers.get('if-none-match') == etag:
+            return Response(content=None, status_code=304,
+                            headers={'ETag': etag})
+
+        return Response(content=body, media_type=fmt, headers={'ETag': etag})
+
+    @get("/table/count")
+    async def count_table(
+        self, base: str, table: str, request: Request, db_cnxn: Connection,
+        schema: str = '', filter: str = ''
     ) -> dict:
+        """Return exact rowcount, when grid shows estimated count"""
         cfg = request.app.state.cfg
-        engine = get_engine(cfg, base)
-        if cfg.system == 'postgresql' and schema:
-            base_path = base + '.' + schema
-        else:
-            base_path = base or schema
-        dbo = Database(engine, base_path, cfg.uid, db_cnxn)
-        tbl = Table(dbo, table)
-        privilege = dbo.user.table_privilege(dbo.schema, table)
-        if privilege.select == 0:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="No access"
-            )
-        grid = Grid(tbl)
-        tbl.limit = limit
-        tbl.offset = offset
-
-        if sort:
-            grid.sort_columns = Dict(json.loads(sort))
-
-        if filter:
-            filter = urllib.parse.unquote(filter)
-            if filter.startswith('where '):
-                where = filter[6:].split(';')[0]
-                grid.cond.prep_stmnts.append(where)
+
+        def count_rows():
+            engine = get_engine(cfg, base)
+            if cfg.system == 'postgresql' and schema:
+                base_path = base + '.' + schema
             else:
-                grid.set_search_cond(filter)
+                base_path = base or schema
+            dbo = Database(engine, base_path, cfg.uid, db_cnxn)
+            tbl = Table(dbo, table)
+            privilege = dbo.user.table_privilege(dbo.schema, table)
+            if privilege.select == 0:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN,
+                    detail="No access"
+                )
+            grid = Grid(tbl)
+
+            if filter:
+                fltr = urllib.parse.unquote(filter)
+                if fltr.startswith('where '):
+                    where = fltr[6:].split(';')[0]
+                    grid.cond.prep_stmnts.append(where)
+                else:
+                    grid.set_search_cond(fltr)
+
+            grid.set_access_cond()
 
-        grid.compressed = compressed
+            return grid.get_rowcount(exact=True)
 
-        # todo: handle sort
-        pkey_vals = None
-        if prim_key:
-            pkey_vals = json.loads(prim_key)
+        count = await db_executor.run(count_rows, request=request,
+                                      cnxn=db_cnxn)
 
-        return {'data': grid.get(pkey_vals)}
+        return {'count': count, 'exact': True}
 
 
     @post("/record", sync_to_thread=True)
@@ -243,11 +334,16 @@ class Database_Controller(Controller):
     async def save_table(self, request: Request, base: str, table: str,
                          db_cnxn: Connection) -> dict:
         cfg = request.app.state.cfg
-        engine = get_engine(cfg, base)
-        dbo = Database(engine, base, cfg.uid, db_cnxn)
-        tbl = Table(dbo, table)
         records = await request.json()
-        return {'data': tbl.save(records)}
+
+        def save():
+            engine = get_engine(cfg, base)
+            dbo = Database(engine, base, cfg.uid, db_cnxn)
+            tbl = Table(dbo, table)
+            return tbl.save(records)
+
+        # Not cancelled on disconnect, so that saving isn't interrupted
+        return {'data': await db_executor.run(save)}
 
 
     @get("/options")
@@ -255,21 +351,25 @@ class Database_Controller(Controller):
         cfg = request.app.state.cfg
         req = Dict({item[0]: item[1]
                     for item in request.query_params.multi_items()})
-        engine = get_engine(cfg, req.base)
-        dbo = Database(engine, req.base, cfg.uid, db_cnxn)
-        tbl = Table(dbo, req.table)
-        fld = Field(tbl, req.column)
-        conds = req.condition.split(" and ") if req.condition else []
-        search = None if 'q' not in req else req.q.replace("*", "%")
-        fkey = tbl.get_fkey(req.column)
-        if search:
-            search = search.lower()
-            view = None if not fkey else fld.get_view(fkey)
-            view = view if view else req.column
-            conds.append(f"lower({view}) like '%{search}%'")
-        cond = " and ".join(conds)
-        data = fld.get_options(cond, {}, get_parent=False)
-        return data
+
+        def load_options():
+            engine = get_engine(cfg, req.base)
+            dbo = Database(engine, req.base, cfg.uid, db_cnxn)
+            tbl = Table(dbo, req.table)
+            fld = Field(tbl, req.column)
+            conds = req.condition.split(" and ") if req.condition else []
+            search = None if 'q' not in req else req.q.replace("*", "%")
+            fkey = tbl.get_fkey(req.column)
+            if search:
+                search = search.lower()
+                view = None if not fkey else fld.get_view(fkey)
+                view = view if view else req.column
+                conds.append(f"lower({view}) like '%{search}%'")
+            cond = " and ".join(conds)
+            return fld.get_options(cond, {}, get_parent=False)
+
+        return await db_executor.run(load_options, request=request,
+                                     cnxn=db_cnxn)
 
 
     @get('/db_file', sync_to_thread=True)
@@ -395,37 +495,82 @@ class Database_Controller(Controller):
 
     @get('/urd/update_cache')
     async def update_cache(self, base: str, config: str,
-                           request: Request, db_cnxn: Connection) -> Stream:
+                           request: Request, db_cnxn: Connection,
+                           incremental: bool = False) -> Stream:
         cfg = request.app.state.cfg
-        engine = get_engine(cfg, base)
-        dbo = Database(engine, base, cfg.uid, db_cnxn)
+        engine = await db_executor.run(get_engine, cfg, base)
+        dbo = await db_executor.run(Database, engine, base, cfg.uid, db_cnxn)
         dbo.config = Dict(json.loads(config))
         dbo.config.update_cache = True
+        # Unchanged tables are taken from last cache if made with same config
+        last_tables = None
+        if (
+            incremental and dbo.last_cache and
+            dbo.last_cache.config == dbo.config
+        ):
+            last_tables = dbo.last_cache.tables
         dbo.cache = None
         dbo.tables = Dict()
 
         def event_stream():
+            # Build cache from fresh metadata
+            dbo.invalidate_metadata()
             if ('html_attributes' not in dbo.tablenames):
                 dbo.create_html_attributes()
-            tbl_count = len(dbo.tablenames)
-            i = 0
+            tables = []
             for tbl in dbo.refl.tables(dbo.schema).values():
-                i += 1
-                progress = round(i/tbl_count * 100)
-                data = json.dumps({'msg': tbl.name, 'progress': progress})
-                yield f"data: {data}\n\n"
-
                 if tbl.name[-5:] == '_view' and tbl.name[:-5] in dbo.tablenames:
                     continue
                 if '_fts' in tbl.name:
                     continue
+                tables.append(tbl)
 
-                table = Table(dbo, tbl.name, type=tbl.type, comment=tbl.comment)
-                dbo.tables[tbl.name] = table.get()
+            i = 0
+            for tbl_name in dbo.update_table_caches(tables, last_tables,
+                                                    workers=cfg.cache_workers):
+                i += 1
+                progress = round(i/len(tables) * 100)
+                data = json.dumps({'msg': tbl_name, 'progress': progress})
+                yield f"data: {data}\n\n"
 
+            # Indexes may have been created
+            dbo.invalidate_metadata()
+            # Used to find changed tables in next incremental update
+            for tbl_name, table in dbo.tables.items():
+                table.fingerprint = dbo.table_fingerprint(tbl_name)
             dbo.get_contents()
             data = json.dumps({'msg': 'done'})
             yield f"data: {data}\n\n"
 
         return Stream(event_stream(), media_type="text/event-stream")
 
+
+    @get('/urd/create_fts')
+    async def create_fts(self, base: str, tables: str, request: Request,
+                         db_cnxn: Connection) -> Stream:
+        """Create full-text indexes used by quick search in grids"""
+        cfg = request.app.state.cfg
+        engine = await db_executor.run(get_engine, cfg, base)
+        dbo = await db_executor.run(Database, engine, base, cfg.uid, db_cnxn)
+        if not dbo.user.is_admin(dbo.schema):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="No access"
+            )
+        tbl_names = json.loads(urllib.parse.unquote(tables))
+
+        def event_stream():
+            skipped = []
+            for i, tbl_name in enumerate(tbl_names, start=1):
+                if not dbo.create_fts_index(tbl_name):
+                    skipped.append(tbl_name)
+                progress = round(i/len(tbl_names) * 100)
+                data = json.dumps({'msg': tbl_name, 'progress': progress})
+                yield f"data: {data}\n\n"
+
+            # Search conditions use the new indexes
+            dbo.invalidate_metadata()
+            data = json.dumps({'msg': 'done', 'skipped': skipped})
+            yield f"data: {data}\n\n"
+
+        return Stream(event_stream(), media_type="text/event-stream")
@@ -1,7 +1,7 @@
 import hashlib
 from litestar import Controller, get, put, Request
 from addict import Dict
-from util import to_rec
+from util import row_factory
 from settings import Settings
 from models.engine import get_engine
 from models.expression import Expression
@@ -30,8 +30,9 @@ class User_Controller(Controller):
                 rows = crsr.fetchall()
                 print('rows', rows)
 
+                make_rec = row_factory(crsr)
                 for row in rows:
-                    rec = to_rec(row, crsr)
+                    rec = make_rec(row)
                     user = Dict()
                     user.name = rec.name
                     user.host = rec.host
@@ -48,8 +49,9 @@ class User_Controller(Controller):
                 crsr.execute(sql)
                 rows = crsr.fetchall()
 
+                make_rec = row_factory(crsr)
                 for row in rows:
-                    rec = to_rec(row, crsr)
+                    rec = make_rec(row)
                     roles.append(rec.name)
 
         cnxn.close()
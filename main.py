@@ -19,14 +19,14 @@ import typer
 from controllers.file import File_Controller
 from controllers.user import User_Controller
 from controllers.database import Database_Controller
-from models.engine import DatabaseManager, get_engine
+from models.engine import db_manager, get_engine
+from models.executor import db_executor
 
 
 cfg = Settings()
 cfg_default = Settings()
 
 mod = os.path.getmtime("static/js/dist/index.js")
-db_manager = DatabaseManager()
 
 # Log errors to console
 logging_config = LoggingConfig(
@@ -34,16 +34,19 @@ logging_config = LoggingConfig(
 )
 
 
-def get_db_connection(base: str | None = None):
-    engine = get_engine(cfg, base)
-    with db_manager.get_pool(engine).connection() as conn:
-        yield conn  # Returns connection to pool after use
+async def get_db_connection(base: str | None = None):
+    # Connecting and validating connections are blocking driver calls.
+    # They may wait for a free connection, and so are not run in the
+    # database thread pool used by requests holding connections
+    engine = await db_executor.checkout(get_engine, cfg, base)
+    # Returns connection to pool after use
+    async with db_executor.connection(db_manager.get_pool(engine)) as conn:
+        yield conn
 
 
 def shutdown_handler():
-    for pool_name, pool in db_manager.pools.items():
-        print(f"Close {pool_name}...")
-        pool.close_all()
+    db_manager.close_all()
+    db_executor.shutdown()
 
 
 def cleanup(temp_file):
@@ -204,7 +207,7 @@ app = Litestar(
         engine=JinjaTemplateEngine,
     ),
     logging_config=logging_config,
-    state=State({'cfg': cfg, 'drivers': drivers}),
+    state=State({'cfg': cfg, 'drivers': drivers, 'db_manager': db_manager}),
     middleware=[login_middleware],
     on_shutdown=[shutdown_handler],
     dependencies={"db_cnxn": Provide(get_db_connection)}
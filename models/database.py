@@ -2,35 +2,64 @@
 import os
 import time
 import csv
+import hashlib
+import queue
 import sys
+import threading
 import shutil
 import tempfile
 from pathlib import Path
 from graphlib import TopologicalSorter
 import sqlglot
-import simplejson as json
+import json
 import pyodbc
 from addict import Dict
 from settings import Settings
 from models.table import Table
-from models.grid import Grid
+from models.grid import Grid, invalidate_grids
 from models.user import User
 from models.datatype import Datatype
-from models.engine import ODBC_Engine
-from models.reflection import Reflection
+from models.engine import ODBC_Engine, db_manager
+from models.executor import db_executor
+from models.reflection import Reflection, get_metadata, invalidate_metadata
 from models.expression import Expression
 import util
 
 
+# Decoded html attributes, keyed by checksum of stored attributes.
+# Kept as plain dicts and lists from the decoder, and converted for
+# each request, so that no request sees values set by others
+html_attributes = util.Cache(maxsize=16)
+
+
+# DuckDB full-text indexes waiting to be rebuilt after writes
+fts_pending = set()
+fts_lock = threading.Lock()
+
+
+def rebuild_fts_index(engine, key, statements):
+    """Rebuild full-text index on connection from pool"""
+    with fts_lock:
+        # Writes from now on schedule a new rebuild
+        fts_pending.discard(key)
+    pool = db_manager.get_pool(engine)
+    cnxn = pool.get_connection()
+    try:
+        with cnxn.cursor() as crsr:
+            for sql in statements:
+                crsr.execute(sql)
+        cnxn.commit()
+    except Exception as e:
+        print(e)
+    finally:
+        pool.release_connection(cnxn)
+
+
 class Database:
     """Contains methods for getting data and metadata from database"""
 
     @util.log_caller
     def __init__(self, engine, db_name, uid, cnxn):
-        self.pkeys_loaded = False
-        self.fkeys_loaded = False
-        self.columns_loaded = False
-        self.indexes_loaded = False
         self.engine = engine
         self.cnxn = cnxn
         self.expr = Expression(engine)
@@ -52,28 +81,36 @@ class Database:
         else:
             self.schema = db_name
             self.cat = None
-        self.refl = Reflection(engine, cnxn)
-
-        if 'urdr' in self.refl.get_schema_names() or db_name == 'urdr':
-            schema = 'main' if db_name == 'urdr' else 'urdr'
-            self.cte_access = f"""
-            with recursive cte_access (code, parent) as (
-                select a1.code, a1.parent
-                from {schema}.access a1
-                join {schema}.user_access ua on ua.access_code = a1.code
-                where ua.user_id = :uid
-                union all
-                select a2.code, a2.parent
-                from {schema}.access a2
-                join cte_access cte on cte.code = a2.parent
-            )
-            """
+        # Metadata already reflected by other requests is reused
+        self.init_metadata()
+        self.pkeys_loaded = 'pkeys' in self.meta
+        self.fkeys_loaded = 'fkeys' in self.meta
+        self.columns_loaded = 'columns' in self.meta
+        self.indexes_loaded = 'indexes' in self.meta
+        self.refl = Reflection(engine, cnxn, cache=self.meta)
+        # Schema reflection fetched ahead by `load_metadata`
+        self._reflected = {}
+        # Table objects shared within request, see `table`
+        self._table_objects = {}
+
+        # Schema with access codes of users, see `cte_access`
+        if 'urdr' in self.schemas or db_name == 'urdr':
+            self.access_schema = 'main' if db_name == 'urdr' else 'urdr'
         else:
-            self.cte_access = None
+            self.access_schema = None
 
         self.html_attrs = self.init_html_attributes()
-        attrs = Dict(self.html_attrs.pop('base', None))
+        attrs = self.html_attrs.pop('base', None) or Dict()
         self.cache = attrs.pop('data-cache', None)
+        # Kept also when outdated, for incremental update of cache
+        self.last_cache = self.cache
+        if (
+            self.cache and self.cache.fingerprint and
+            self.cache.fingerprint != self.meta.fingerprint
+        ):
+            # Schema is changed after cache was made
+            print(f"Cache for {self.identifier} is outdated")
+            self.cache = None
         if attrs.get('cache.config', None):
             self.config = self.cache.config
         else:
@@ -83,8 +120,88 @@ class Database:
                 'exportdir': config.exportdir
             })
 
+    @property
+    def cte_access(self):
+        """Return cte with access codes of user, made when first used"""
+        if self.access_schema is None:
+            return None
+        if not hasattr(self, '_cte_access'):
+            self._cte_access = self.init_cte_access(self.access_schema)
+
+        return self._cte_access
+
+    @property
+    def access_params(self):
+        """Params used with `cte_access`"""
+        if not self.cte_access:
+            return {}
+
+        return self._access_params
+
+    def init_cte_access(self, schema):
+        """Return cte with the access codes of the user
+
+        The access codes are found once for each login, and bound as
+        parameters. Falls back to finding them recursively in the
+        query if there are too many.
+        """
+        codes = self.user.get_access_codes(schema)
+        if len(codes) > Settings().max_access_params:
+            self._access_params = {'uid': self.user.name}
+            # Recursion is implicit in Oracle and SQL Server
+            recursive = ('' if self.expr.dialect in ('oracle', 'mssql')
+                         else 'recursive ')
+            return f"""
+            with {recursive}cte_access (code, parent) as (
+                select a1.code, a1.parent
+                from {schema}.access a1
+                join {schema}.user_access ua on ua.access_code = a1.code
+                where ua.user_id = :uid
+                union all
+                select a2.code, a2.parent
+                from {schema}.access a2
+                join cte_access cte on cte.code = a2.parent
+            )
+            """
+
+        self._access_params = {f'access_code{i}': code
+                               for i, code in enumerate(codes)}
+        # Oracle doesn't allow select without from
+        dual = ' from dual' if self.expr.dialect == 'oracle' else ''
+        selects = [f'select :{param}{dual}' for param in self._access_params]
+        if not selects:
+            selects = [f'select null{dual} where 1 = 0']
+        union = '\n                union all '.join(selects)
+
+        return f"""
+            with cte_access (code) as (
+                {union}
+            )
+            """
+
+    def init_metadata(self):
+        """Get shared metadata, and check that the schema is unchanged"""
+        self.meta = get_metadata(self.engine, self.schema)
+        now = time.monotonic()
+        interval = Settings().metadata_check_interval
+        if now - (self.meta.checked or 0) < interval:
+            return
+        refl = Reflection(self.engine, self.cnxn)
+        fingerprint = refl.fingerprint(self.schema)
+        if self.meta.checked and fingerprint != self.meta.fingerprint:
+            invalidate_metadata(self.engine.host, self.engine.db_name,
+                                self.schema)
+            self.meta = get_metadata(self.engine, self.schema)
+        self.meta.fingerprint = fingerprint
+        self.meta.checked = now
+
     def init_html_attributes(self):
-        """Get data from table html_attributes"""
+        """Get data from table html_attributes
+
+        Decoding is done only when the stored attributes have changed,
+        since the data-cache may be large. Decoded attributes are kept
+        in memory.
+        """
         attrs = Dict()
         if 'html_attributes' in self.tablenames:
             sql = f"""
@@ -96,13 +213,35 @@ class Database:
                     sql, _ = self.expr.prepare(sql)
                     crsr.execute(sql)
                     rows = crsr.fetchall()
+            except Exception as e:
+                print(e)
+                return attrs
+
+            checksum = hashlib.blake2b(digest_size=16)
+            for row in rows:
+                if row is None:
+                    break
+                checksum.update(f'{row[0]}\0{row[1]}\0'.encode('utf-8'))
+            key = checksum.hexdigest()
+
+            decoded = html_attributes.get(key)
+            if decoded is None:
+                decoded = {}
+                try:
                     for row in rows:
                         if row is None:
                             break
-                        rec = util.to_rec(row, crsr)
-                        attrs[rec.selector] = json.loads(rec.attrs)
-            except Exception as e:
-                print(e)
+                        decoded[row[0]] = util.decode_json(row[1])
+                except Exception as e:
+                    print(e)
+                    return attrs
+                html_attributes.set(key, decoded)
+
+            for selector, value in decoded.items():
+                # Other selectors are only read, but 'base' holds the
+                # data-cache, which tables write to. Dict converts it
+                # recursively into new objects.
+                attrs[selector] = Dict(value) if selector == 'base' else value
 
         return attrs
 
@@ -143,6 +282,115 @@ class Database:
 
         return comment
 
+    def fts_statements(self, tbl_name):
+        """Return statements creating full-text index for quick search
+
+        SQLite gets an FTS5 table with the table as external content,
+        kept up to date by triggers. DuckDB indexes are made with the
+        fts extension, and must be rebuilt after writes.
+        """
+        tbl = self.table(tbl_name)
+        cols = [field.name for field in tbl.fields.values()
+                if field.datatype == 'str' and 'source' not in field]
+        if not cols:
+            return []
+
+        def quote(name):
+            return '"' + name.replace('"', '""') + '"'
+
+        def literal(value):
+            return "'" + value.replace("'", "''") + "'"
+
+        if self.expr.dialect == 'sqlite':
+            # External content is looked up by rowid, so tables
+            # without rowid can't be indexed
+            try:
+                with self.cnxn.cursor() as crsr:
+                    crsr.execute(f'select rowid from {quote(tbl_name)} '
+                                 'limit 0')
+            except Exception:
+                return []
+            tbl = quote(tbl_name)
+            fts = quote(tbl_name + '_fts')
+            col_list = ', '.join(quote(col) for col in cols)
+            news = ', '.join('new.' + quote(col) for col in cols)
+            olds = ', '.join('old.' + quote(col) for col in cols)
+            delete = (f"insert into {fts}({fts}, rowid, {col_list}) "
+                      f"values ('delete', old.rowid, {olds});")
+            insert = (f"insert into {fts}(rowid, {col_list}) "
+                      f"values (new.rowid, {news});")
+            triggers = {suffix: quote(f'{tbl_name}_fts_{suffix}')
+                        for suffix in ('ai', 'ad', 'au')}
+            return [
+                f"drop table if exists {fts}",
+                f"create virtual table {fts} using fts5({col_list}, "
+                f"content={literal(tbl_name)})",
+                f"drop trigger if exists {triggers['ai']}",
+                f"drop trigger if exists {triggers['ad']}",
+                f"drop trigger if exists {triggers['au']}",
+                f"create trigger {triggers['ai']} after insert on {tbl} "
+                f"begin {insert} end",
+                f"create trigger {triggers['ad']} after delete on {tbl} "
+                f"begin {delete} end",
+                f"create trigger {triggers['au']} after update on {tbl} "
+                f"begin {delete} {insert} end",
+                f"insert into {fts}({fts}) values ('rebuild')"
+            ]
+        elif self.expr.dialect == 'duckdb':
+            # Rows are identified by a single column primary key
+            if len(tbl.pkey.columns) != 1:
+                return []
+            args = ', '.join(literal(arg) for arg in
+                             [tbl_name, tbl.pkey.columns[0]] + cols)
+            return [f"pragma create_fts_index({args}, overwrite=1)"]
+        else:
+            return []
+
+    def create_fts_index(self, tbl_name):
+        """Create full-text index used by quick search in grid"""
+        statements = self.fts_statements(tbl_name)
+        if not statements:
+            return False
+
+        with self.cnxn.cursor() as crsr:
+            for sql in statements:
+                crsr.execute(sql)
+            self.cnxn.commit()
+        invalidate_grids(self.engine, [tbl_name])
+
+        return True
+
+    def fts_schema(self, tbl_name):
+        """Return schema with DuckDB full-text index for table, if any"""
+        if self.expr.dialect != 'duckdb':
+            return None
+        if tbl_name not in self.meta.fts_schemas:
+            sql = """
+            select schema_name from duckdb_schemas()
+            where schema_name in (:default_name, :schema_name)
+            """
+            params = {'default_name': f'fts_main_{tbl_name}',
+                      'schema_name': f'fts_{self.schema}_{tbl_name}'}
+            with self.cnxn.cursor() as crsr:
+                sql, params = self.expr.prepare(sql, params)
+                crsr.execute(sql, params)
+                row = crsr.fetchone()
+            self.meta.fts_schemas[tbl_name] = row[0] if row else None
+
+        return self.meta.fts_schemas[tbl_name]
+
+    def schedule_fts_refresh(self, tbl_name):
+        """Rebuild DuckDB full-text index in background after writes"""
+        if not self.fts_schema(tbl_name):
+            return
+        key = (self.engine.host, self.engine.db_name, self.schema, tbl_name)
+        with fts_lock:
+            if key in fts_pending:
+                return
+            fts_pending.add(key)
+        db_executor.submit(rebuild_fts_index, self.engine, key,
+                           self.fts_statements(tbl_name))
+
     def create_html_attributes(self):
         """Create table holding html_attributes"""
 
@@ -162,7 +410,7 @@ class Database:
             crsr.execute(sql)
             self.cnxn.commit()
 
-        self.tablenames.append('html_attributes')
+        self.invalidate_metadata()
         attributes = {
             'data-format': 'yaml'
         }
@@ -181,7 +429,7 @@ class Database:
 
         # Refresh attributes
         self.html_attrs = self.init_html_attributes()
-        attrs = Dict(self.html_attrs.pop('base', None))
+        attrs = self.html_attrs.pop('base', None) or Dict()
         self.cache = attrs.pop('data-cache', None)
 
     def get_tables(self):
@@ -195,9 +443,7 @@ class Database:
         self.tables = Dict()
 
         # Loads metadata so we don't have to load for each table
-        self.fkeys
-        self.indexes
-        self.pkeys
+        self.load_metadata()
 
         for tbl in self.refl.tables(self.schema).values():
             if tbl.name[-5:] == '_view' and tbl.name[:-5] in self.tablenames:
@@ -213,6 +459,115 @@ class Database:
 
         return self.tables
 
+    def table(self, tbl_name):
+        """Return Table object, shared within this request
+
+        Used for tables referred to by foreign keys and relations, so
+        that their indexes, relations and joins are found only once.
+        """
+        if tbl_name not in self._table_objects:
+            self._table_objects[tbl_name] = Table(self, tbl_name)
+
+        return self._table_objects[tbl_name]
+
+    def table_fingerprint(self, tbl_name):
+        """Return checksum of reflected structure of table
+
+        Includes relations from other tables, as these are part
+        of the cached table.
+        """
+        struct = {
+            'columns': self.columns.get(tbl_name),
+            'pkey': self.pkeys.get(tbl_name),
+            'indexes': self.indexes.get(tbl_name),
+            'fkeys': self.fkeys.get(tbl_name),
+            'relations': self.relations.get(tbl_name)
+        }
+        text = json.dumps(struct, sort_keys=True, default=str)
+
+        return hashlib.blake2b(text.encode('utf-8'),
+                               digest_size=16).hexdigest()
+
+    def build_table_cache(self, tbl, last=None):
+        """Return table metadata for cache
+
+        The table from last cache is returned if its structure
+        and row count are unchanged.
+        """
+        table = Table(self, tbl.name, type=tbl.type, comment=tbl.comment)
+        if (
+            last and last.fingerprint == self.table_fingerprint(tbl.name)
+            and last.rowcount == table.rowcount
+        ):
+            # Copy, as last cache may be shared with other requests
+            return Dict(last)
+
+        return table.get()
+
+    def update_table_caches(self, tables, last_tables=None, workers=1):
+        """Build cache for tables, and yield each table name when done
+
+        Tables are found in `last_tables` if unchanged. Otherwise they
+        are built concurrently, using this connection and up to
+        `workers - 1` extra connections from the connection pool.
+        """
+        # Load metadata once, to be shared between workers
+        self.load_metadata()
+
+        todo = queue.SimpleQueue()
+        for tbl in tables:
+            todo.put(tbl)
+        done = queue.SimpleQueue()
+        stop = threading.Event()
+        last_tables = last_tables or Dict()
+
+        def work(dbo):
+            while not stop.is_set():
+                try:
+                    tbl = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    done.put((tbl.name, dbo.build_table_cache(
+                        tbl, last_tables.get(tbl.name))))
+                except Exception as e:
+                    done.put((tbl.name, e))
+
+        def work_on_pool():
+            pool = db_manager.get_pool(self.engine)
+            try:
+                cnxn = pool.get_connection(timeout=0)
+            except Exception:
+                # No connections available, so leave work to others
+                return
+            try:
+                dbo = Database(self.engine, self.identifier, self.user.name,
+                               cnxn)
+                dbo.config = self.config
+                dbo.cache = None
+                dbo.tables = Dict()
+                work(dbo)
+            finally:
+                pool.release_connection(cnxn)
+
+        threads = [threading.Thread(target=work, args=(self,))]
+        threads += [threading.Thread(target=work_on_pool)
+                    for _ in range(min(workers, len(tables)) - 1)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for _ in tables:
+                tbl_name, result = done.get()
+                if isinstance(result, Exception):
+                    raise result
+                self.tables[tbl_name] = result
+                yield tbl_name
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
     @property
     def schemas(self):
         if hasattr(self, '_schemas'):
@@ -433,7 +788,7 @@ class Database:
 
         sub_tables = Dict()
         for tbl_name, table in self.tables.items():
-            tbl = Table(self, tbl_name)
+            tbl = self.table(tbl_name)
 
             if tbl.type == 'xref':
                 continue
@@ -444,7 +799,7 @@ class Database:
                     if tbl.type == 'ext' and fkey.relationship == '1:M':
                         continue
 
-                    ref_tbl = Table(self, fkey.referred_table)
+                    ref_tbl = self.table(fkey.referred_table)
                     if ref_tbl.type == 'list' and tbl.type != 'list':
                         continue
 
@@ -548,12 +903,14 @@ class Database:
             cache = {
                 "tables": self.tables,
                 "contents": contents,
-                "config": self.config
+                "config": self.config,
+                # To find out if the cache is outdated
+                "fingerprint": self.refl.fingerprint(self.schema)
             }
             attrs = {
                 'data-cache': cache
             }
-            attrs_txt = json.dumps(attrs)
+            attrs_txt = util.encode(attrs).decode()
 
             if count:
                 sql = f"""
@@ -577,6 +934,62 @@ class Database:
 
         return contents
 
+    def load_metadata(self):
+        """Load columns, primary keys, indexes and foreign keys
+
+        The catalog queries are independent, so these are run
+        concurrently on extra connections from the connection pool,
+        up to `reflection_workers` in Settings. Categories that get
+        no connection are reflected on this connection.
+        """
+        categories = [name for name in ('columns', 'pkeys', 'indexes', 'fkeys')
+                      if name not in self.meta]
+        workers = min(Settings().reflection_workers, len(categories))
+        if workers > 1:
+            pool = db_manager.get_pool(self.engine)
+            meta = self.meta
+
+            def fetch(category, cnxn):
+                refl = Reflection(self.engine, cnxn, cache=meta)
+                discard = False
+                try:
+                    result = getattr(refl, category)(self.schema)
+                    if category != 'columns':
+                        # Columns are stored in `meta` by reflection
+                        self._reflected[category] = result
+                except Exception as e:
+                    # Reflected again on this connection, raising the error
+                    print(e)
+                    discard = True
+                finally:
+                    pool.release_connection(cnxn, discard=discard)
+
+            threads = []
+            for category in categories[:workers]:
+                try:
+                    cnxn = pool.get_connection(timeout=0)
+                except Exception:
+                    break
+                threads.append(threading.Thread(target=fetch,
+                                                args=(category, cnxn)))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Assemble results, and reflect what's not fetched yet
+        self.columns
+        self.pkeys
+        self.indexes
+        self.fkeys
+
+    def reflect(self, category):
+        """Return reflected category for schema, if possible prefetched"""
+        if category in self._reflected:
+            return self._reflected.pop(category)
+
+        return getattr(self.refl, category)(self.schema)
+
     @property
     def pkeys(self):
         """Get primary key of table"""
@@ -585,8 +998,12 @@ class Database:
             return self._pkeys
 
         self.pkeys_loaded = True
+        if 'pkeys' in self.meta:
+            self._pkeys = self.meta.pkeys
+            return self._pkeys
+
         self._pkeys = Dict()
-        pkey_constraints = self.refl.pkeys(self.schema)
+        pkey_constraints = self.reflect('pkeys')
         for table, pkey in pkey_constraints.items():
             self._pkeys[table] = Dict({
                 'table_name': table,
@@ -594,6 +1011,7 @@ class Database:
                 'unique': True,
                 'columns': pkey['constrained_columns']
             })
+        self.meta.pkeys = self._pkeys
 
         return self._pkeys
 
@@ -602,9 +1020,12 @@ class Database:
         self.indexes_loaded = True
         if hasattr(self, '_indexes'):
             return self._indexes
+        if 'indexes' in self.meta:
+            self._indexes = self.meta.indexes
+            return self._indexes
 
         self._indexes = Dict()
-        schema_indexes = self.refl.indexes(self.schema)
+        schema_indexes = self.reflect('indexes')
 
         for table, indexes in schema_indexes.items():
 
@@ -619,6 +1040,7 @@ class Database:
         for table in self.pkeys:
             pkey = self.pkeys[table]
             self._indexes[table][pkey.name] = pkey
+        self.meta.indexes = self._indexes
 
         return self._indexes
 
@@ -628,11 +1050,15 @@ class Database:
         if hasattr(self, '_fkeys'):
             return self._fkeys
         self.fkeys_loaded = True
+        if 'fkeys' in self.meta:
+            self._fkeys = self.meta.fkeys
+            self._relations = self.meta.relations
+            return self._fkeys
 
         self._fkeys = Dict()
         self._relations = Dict()
 
-        schema_fkeys = self.refl.fkeys(self.schema)
+        schema_fkeys = self.reflect('fkeys')
 
         for tbl_name, fkeys in schema_fkeys.items():
             for fkey in fkeys:
@@ -640,6 +1066,9 @@ class Database:
                 fkey.ref_table_alias = alias
                 self._fkeys[fkey.table_name][fkey.name] = fkey
                 self._relations[fkey.referred_table][fkey.name] = fkey
+        # Set relations first, as fkeys tells that both are loaded
+        self.meta.relations = self._relations
+        self.meta.fkeys = self._fkeys
 
         return self._fkeys
 
@@ -651,6 +1080,21 @@ class Database:
 
         return self._relations
 
+    def invalidate_metadata(self):
+        """Reflect schema again, after changes to it"""
+        invalidate_metadata(self.engine.host, self.engine.db_name, self.schema)
+        for attr in ('_schemas', '_tablenames', '_viewnames', '_columns',
+                     '_pkeys', '_indexes', '_fkeys', '_relations'):
+            self.__dict__.pop(attr, None)
+        self._reflected = {}
+        self._table_objects = {}
+        self.pkeys_loaded = False
+        self.fkeys_loaded = False
+        self.columns_loaded = False
+        self.indexes_loaded = False
+        self.init_metadata()
+        self.refl.cache = self.meta
+
     @property
     def functions(self):
         """Get all functions in database"""
@@ -662,8 +1106,9 @@ class Database:
             sql, params = self.expr.prepare(sql, {'owner': self.schema})
             crsr.execute(sql, params)
             rows = crsr.fetchall()
+            make_rec = util.row_factory(crsr)
             for row in rows:
-                rec = util.to_rec(row, crsr)
+                rec = make_rec(row)
                 if rec.name not in functions:
                     functions[rec.name] = rec.text
                 else:
@@ -681,8 +1126,9 @@ class Database:
             sql, params = self.expr.prepare(sql, {'owner': self.schema})
             crsr.execute(sql, params)
             rows = crsr.fetchall()
+            make_rec = util.row_factory(crsr)
             for row in rows:
-                rec = util.to_rec(row, crsr)
+                rec = make_rec(row)
                 if rec.name not in procedures:
                     procedures[rec.name] = rec.text
                 else:
@@ -745,7 +1191,7 @@ class Database:
                 else:
                     rows = crsr.fetchall()
 
-                query.data = [util.to_rec(row, crsr) for row in rows]
+                query.data = util.to_recs(rows, crsr)
                 # Find the table selected from
                 query.table = str(sqlglot.parse_one(query.string)
                                   .find(sqlglot.exp.Table))
@@ -766,6 +1212,13 @@ class Database:
 
             self.cnxn.commit()
 
+        keyword = sql.split(None, 1)[0].lower()
+        if keyword in ('create', 'alter', 'drop', 'rename', 'comment'):
+            self.invalidate_metadata()
+        if keyword not in ('select', 'show', 'describe', 'explain', 'pragma'):
+            # The statement may have changed any table
+            invalidate_grids(self.engine)
+
         return query
 
     @util.time_stream_generator
@@ -806,8 +1259,9 @@ class Database:
                     sql, params = self.expr.prepare(sql, {'schema': self.schema})
                     crsr.execute(sql, params)
                     rows = crsr.fetchall()
+                    make_rec = util.row_factory(crsr)
                     for row in rows:
-                        rec = util.to_rec(row, crsr)
+                        rec = make_rec(row)
                         count_recs[rec.table_name] = rec.count_rows
                         total_rows += rec.count_rows
                         if rec.count_rows or not no_empty:
@@ -948,6 +1402,7 @@ class Database:
                         # per `insert all` in Oracle after a certain value.
                         # This value is around 50 for version 19c
                         max = 50 if dialect == 'oracle' else 1000
+                        make_rec = util.row_factory(crsr)
 
                         while True:
                             rows = crsr.fetchmany(max)
@@ -974,7 +1429,7 @@ class Database:
                                 insert = ''
                                 if dialect == 'oracle' and i > 1:
                                     insert += ' union all\n'
-                                rec = util.to_rec(row, crsr)
+                                rec = make_rec(row)
                                 if i != 1 and dialect != 'oracle':
                                     insert += ','
                                 insert += expr.insert_rec(tbl, rec)
@@ -1107,6 +1562,7 @@ class Database:
                     print(sql)
                 n = 0
                 num_files = 0
+                make_rec = util.row_factory(crsr)
                 for row in crsr:
                     progress = '{:.1f}'.format(round(count/total_rows * 100, 1))
                     if progress != last_progress:
@@ -1117,7 +1573,7 @@ class Database:
                         break
                     n += 1
                     count += 1
-                    rec = util.to_rec(row, crsr)
+                    rec = make_rec(row)
                     if n == 1:
                         file.write('\t'.join(rec.keys()) + '\n')
                     values = []
@@ -2,18 +2,50 @@ import importlib
 import os
 import re
 import hashlib
-import queue
+import threading
+import time
+import functools
+from collections import deque, OrderedDict
 import pyodbc
 from addict import Dict
-from litestar.status_codes import HTTP_401_UNAUTHORIZED
+from litestar.status_codes import (HTTP_401_UNAUTHORIZED,
+                                   HTTP_503_SERVICE_UNAVAILABLE)
 from fastapi import HTTPException
 from contextlib import closing
 from models.expression import Expression
 from models.reflection import Reflection
-from settings import drivers
+from settings import drivers, Settings
+from util import Cache
+
+
+def login_identity(cfg):
+    """Return hash identifying the login without exposing the password"""
+    login = f'{cfg.uid}:{cfg.pwd}'
+    return hashlib.sha256(login.encode('utf-8')).hexdigest()[:16]
+
+
+# Engines are shared between requests with the same login and database
+engines = Cache(maxsize=256)
+# Logins verified against the urdr database
+verified_logins = Cache(maxsize=1024, ttl=Settings().login_ttl)
 
 
 def get_engine(cfg, db_name=None):
+    """Get engine from registry, or create it"""
+    key = (cfg.system, cfg.driver, cfg.host, db_name, cfg.database,
+           cfg.uid, login_identity(cfg))
+    engine = engines.get(key)
+    if engine is None:
+        engine = create_engine(cfg, db_name)
+        engines.set(key, engine)
+
+    if cfg.system == 'sqlite' and db_name == 'urdr':
+        verify_login(engine, cfg, db_name)
+
+    return engine
+
+
+def create_engine(cfg, db_name=None):
     driver = drivers[cfg.system][cfg.driver]
     driver.name = cfg.driver
     if cfg.driver == 'pyodbc':
@@ -21,85 +53,321 @@ def get_engine(cfg, db_name=None):
     else:
         engine = Engine(cfg, driver, db_name)
 
-    if cfg.system == 'sqlite' and db_name == 'urdr':
-        with engine.connect() as cnxn:
-            sql = """
-            select count(*) from user
-            where id = :id and password = :pwd
-            """
-
-            hashed_pwd = hashlib.sha256(cfg.pwd.encode('utf-8')).hexdigest()
-            expr = Expression(engine)
-            sql, params = expr.prepare(sql, {'id': cfg.uid, 'pwd': hashed_pwd})
-            crsr = cnxn.cursor()
+    if cfg.system == 'sqlite' and db_name != 'urdr' and cfg.database == 'urdr':
+        # Attached on every new connection, see `Engine.connect`
+        path = os.path.join(cfg.host, cfg.database + '.db')
+        engine.init_sql.append('ATTACH DATABASE "' + path + '" as urdr')
+
+    return engine
+
+
+def verify_login(engine, cfg, db_name):
+    """Check user and password against the urdr database
+
+    Only successful logins are cached, so that new users and changed
+    passwords take effect at once.
+    """
+    key = (cfg.host, cfg.uid, engine.identity)
+    if verified_logins.get(key):
+        return
+
+    # Short-lived connection, since callers may already hold a connection
+    # from the pool, and waiting for another could block until timeout
+    with engine.connect() as cnxn:
+        sql = """
+        select count(*) from user
+        where id = :id and password = :pwd
+        """
+
+        hashed_pwd = hashlib.sha256(cfg.pwd.encode('utf-8')).hexdigest()
+        expr = Expression(engine)
+        sql, params = expr.prepare(sql, {'id': cfg.uid, 'pwd': hashed_pwd})
+        with cnxn.cursor() as crsr:
             crsr.execute(sql, params)
             count = crsr.fetchone()[0]
 
-            if count == 0:
-                raise HTTPException(
-                    status_code=HTTP_401_UNAUTHORIZED,
-                    detail={
-                        'msg': "Invalid authentication",
-                        "system": cfg.system,
-                        "host": cfg.host,
-                        "database": db_name
-                    }
-                )
-    elif cfg.system == 'sqlite' and cfg.database == 'urdr':
-        with engine.connect() as cnxn:
-            path = os.path.join(cfg.host, cfg.database + '.db')
-            sql = 'ATTACH DATABASE "' + path + '" as urdr'
-            crsr = cnxn.cursor()
-            crsr.execute(sql)
+    if count == 0:
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail={
+                'msg': "Invalid authentication",
+                "system": cfg.system,
+                "host": cfg.host,
+                "database": db_name
+            }
+        )
+    verified_logins.set(key, True)
 
-    return engine
+
+@functools.cache
+def odbc_drivers():
+    """Installed ODBC drivers, found once per process"""
+    return pyodbc.drivers()
 
 
 class DatabaseManager:
+    """Registry of connection pools, one for each login and database
+
+    The total number of open connections is kept within
+    `max_connections` in Settings, by closing idle connections in the
+    least recently used pools. Pools without connections are removed,
+    and created again on demand.
+    """
+
     def __init__(self):
-        self.pools = {}
+        self.pools = OrderedDict()
+        self._lock = threading.RLock()
+        self.max_connections = Settings().max_connections
 
     def get_pool(self, engine):
         """Get pool based on engine"""
-        key = engine.driver_name + ':' + engine.host + '/' + str(engine.db_name or '')
-        if key not in self.pools:
-            self.pools[key] = ConnectionPool(engine.connect, pool_size=5)
-        return self.pools[key]
+        key = (f'{engine.driver_name}:{engine.url.username}@{engine.host}/'
+               f'{engine.db_name or ""}#{engine.identity}')
+        # Lock so that concurrent first requests don't create duplicate pools
+        with self._lock:
+            if key not in self.pools:
+                cfg = Settings()
+                # Pool settings may be overridden per driver in drivers.yml
+                opts = Dict(engine.driver.get('pool', {}))
+                pre_ping = (cfg.pool_pre_ping if opts.pre_ping == {}
+                            else opts.pre_ping)
+                self.pools[key] = ConnectionPool(
+                    engine.connect,
+                    pool_size=opts.size or cfg.pool_size,
+                    max_overflow=(cfg.pool_max_overflow
+                                  if opts.max_overflow == {}
+                                  else opts.max_overflow),
+                    min_size=(cfg.pool_min_size if opts.min_size == {}
+                              else opts.min_size),
+                    timeout=opts.timeout or cfg.pool_timeout,
+                    recycle=opts.recycle or cfg.pool_recycle,
+                    idle_timeout=opts.idle_timeout or cfg.pool_idle_timeout,
+                    ping_sql=Expression(engine).ping() if pre_ping else None,
+                    manager=self,
+                    key=key
+                )
+            self.pools.move_to_end(key)
+            return self.pools[key]
+
+    @property
+    def num_connections(self):
+        """Number of open connections in all pools"""
+        return sum(pool.size for pool in self.pools.values())
+
+    def make_room(self, pool):
+        """Make room for a new connection in `pool` within the budget
+
+        The slot for the new connection is already counted in
+        `pool.size`. Closes idle connections in the least recently used
+        pools, and removes pools left without connections. Returns False
+        if the budget is used by connections in use.
+        """
+        with self._lock:
+            if not any(other is pool for other in self.pools.values()):
+                # Pool was removed after it was handed out by `get_pool`,
+                # so register it again to count its connections, and
+                # to close them in `close_all`
+                key = pool.key
+                if key in self.pools:
+                    key = (pool.key, id(pool))
+                self.pools[key] = pool
+            for key, other in list(self.pools.items()):
+                if self.num_connections <= self.max_connections:
+                    break
+                if other is pool:
+                    continue
+                other.close_idle()
+                if other.size == 0:
+                    del self.pools[key]
+
+            return self.num_connections <= self.max_connections
+
+    def close_all(self):
+        """Close all pools"""
+        with self._lock:
+            for pool_name, pool in self.pools.items():
+                print(f"Close {pool_name}...")
+                pool.close_all()
+            self.pools.clear()
+
+
+db_manager = DatabaseManager()
 
 
 class ConnectionPool:
-    def __init__(self, create_connection_fn, pool_size=5):
-        self._pool = queue.Queue(maxsize=pool_size)
+    """Pool of database connections
+
+    Connections are created lazily when needed. The pool keeps up to
+    `pool_size` idle connections, and allows `max_overflow` extra
+    connections under load. These are closed when released.
+    Connections are validated on checkout, and replaced when older
+    than `recycle` seconds. Idle connections are closed after
+    `idle_timeout` seconds, but at least `min_size` are kept.
+    """
+
+    def __init__(self, create_connection_fn, pool_size=5, max_overflow=5,
+                 min_size=0, timeout=30, recycle=3600, idle_timeout=600,
+                 ping_sql=None, manager=None, key=None):
+        self._create_connection = create_connection_fn
+        self._manager = manager
+        self.key = key
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.min_size = min(min_size, pool_size)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.idle_timeout = idle_timeout
+        self.ping_sql = ping_sql
+        self._idle = deque()
+        self._checked_out = 0
+        self._closed = False
+        self._cond = threading.Condition()
 
-        # Fill pool with initial connections
-        for _ in range(pool_size):
-            conn = create_connection_fn()
-            self._pool.put(conn)
+    @property
+    def size(self):
+        """Number of open connections, idle or in use"""
+        return len(self._idle) + self._checked_out
 
     def get_connection(self, timeout=None):
-        """Get en available connection from the queue"""
+        """Get an available connection, or create one if allowed"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        expired = []
+        while True:
+            with self._cond:
+                while True:
+                    expired += self._evict_idle()
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    elif self.size < self.pool_size + self.max_overflow:
+                        conn = None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeout_error()
+                    self._cond.wait(remaining)
+                # Reserve the connection, or the slot for a new one
+                self._checked_out += 1
+
+            # A new connection must also fit within the global budget.
+            # The manager is called without holding the lock, since it
+            # may close idle connections in other pools
+            if (
+                conn is not None or self._manager is None or
+                self._manager.make_room(self)
+            ):
+                break
+
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            # Connections released in other pools don't notify this
+            # pool, so check the budget again after a short while
+            if time.monotonic() >= deadline:
+                self._timeout_error()
+            time.sleep(0.1)
+
+        # Close and validate connections outside the lock, since this
+        # involves round trips to the database server
+        for old_conn in expired:
+            self._close(old_conn)
         try:
-            return self._pool.get(block=True, timeout=timeout)
-        except queue.Empty:
-            raise Exception("Ingen ledige tilkoblinger i poolen.")
-
-    def release_connection(self, conn):
-        """Return connection to queue"""
-        self._pool.put(conn)
+            if conn is not None and not self._is_usable(conn):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self._create_connection()
+        except Exception:
+            with self._cond:
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+
+        return conn
+
+    def release_connection(self, conn, discard=False):
+        """Return connection to pool, or close it if not to be kept"""
+        keep = not discard and not self._is_expired(conn)
+        with self._cond:
+            self._checked_out -= 1
+            keep = keep and not self._closed and len(self._idle) < self.pool_size
+            if keep:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+        if not keep:
+            self._close(conn)
 
     def close_all(self):
         """Closes all connections in the pool"""
-        while not self._pool.empty():
-            conn = self._pool.get()
-            try:
-                conn.close()
-            except Exception:
-                pass # Ignorer feil under stenging
+        with self._cond:
+            self._closed = True
+            conns = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in conns:
+            self._close(conn)
+
+    def close_idle(self):
+        """Closes idle connections, but keeps the pool open"""
+        with self._cond:
+            conns = list(self._idle)
+            self._idle.clear()
+        for conn in conns:
+            self._close(conn)
 
     def connection(self):
         """Context manager for using 'with'"""
         return ConnectionContextManager(self)
 
+    def _timeout_error(self):
+        raise HTTPException(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No available database connections"
+        )
+
+    def _evict_idle(self):
+        """Remove connections that have been idle too long.
+
+        Must be called with lock held. Returns the removed connections,
+        which should be closed after the lock is released.
+        """
+        expired = []
+        now = time.monotonic()
+        while (
+            self._idle and self.size > self.min_size and
+            now - self._idle[0].last_used > self.idle_timeout
+        ):
+            expired.append(self._idle.popleft())
+
+        return expired
+
+    def _is_expired(self, conn):
+        return (self.recycle is not None and
+                time.monotonic() - conn.created > self.recycle)
+
+    def _is_usable(self, conn):
+        """Check that connection is not too old, and is still alive"""
+        if self._is_expired(conn):
+            return False
+        if self.ping_sql:
+            try:
+                with conn.cursor() as crsr:
+                    crsr.execute(self.ping_sql)
+                    crsr.fetchall()
+            except Exception:
+                return False
+
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass  # Ignore errors when closing
+
+
 class ConnectionContextManager:
     def __init__(self, pool):
         self.pool = pool
@@ -111,7 +379,14 @@ class ConnectionContextManager:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.conn:
-            self.pool.release_connection(self.conn)
+            discard = False
+            if exc_type is not None:
+                # Don't leave an aborted transaction for the next user
+                try:
+                    self.conn.rollback()
+                except Exception:
+                    discard = True
+            self.pool.release_connection(self.conn, discard=discard)
 
 
 class Connection:
@@ -119,6 +394,14 @@ class Connection:
     def __init__(self, cnxn, driver):
         self._cnxn = cnxn
         self.driver = driver
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     def cursor(self):
         options = self.driver.get('options', {})
@@ -128,6 +411,21 @@ class Connection:
     def commit(self):
         return self._cnxn.commit()
 
+    def rollback(self):
+        return self._cnxn.rollback()
+
+    def cancel(self):
+        """Interrupt statement running in other thread, if supported"""
+        for method in ('interrupt', 'cancel'):
+            # sqlite3 and duckdb have `interrupt`, psycopg2 and
+            # oracledb have `cancel`
+            if hasattr(self._cnxn, method):
+                try:
+                    getattr(self._cnxn, method)()
+                except Exception as ex:
+                    print(ex)
+                return
+
     def close(self):
         return self._cnxn.close()
 
@@ -140,6 +438,7 @@ class Engine:
         self.db_name = db_name
         self.host = cfg.host
         self.driver = driver
+        self.identity = login_identity(cfg)
         try:
             self.driver_module = importlib.import_module(driver.name, package=None)
         except ImportError:
@@ -185,15 +484,17 @@ class Engine:
             'database': (config.path if cfg.system in ('sqlite', 'duckdb')
                          else db_name.split('.')[0] if db_name else None)
         })
+        # Statements run on every new connection
+        self.init_sql = []
 
     @property
     def version(self):
         if hasattr(self, '_version'):
             return self._version
-        cnxn = self.connect()
-        refl = Reflection(self, cnxn)
-        self._version = refl.get_version()
-        cnxn.close()
+        # Not from the pool, see `verify_login`
+        with self.connect() as cnxn:
+            refl = Reflection(self, cnxn)
+            self._version = refl.get_version()
         return self._version
 
     def connect(self):
@@ -210,6 +511,8 @@ class Engine:
             )
         if self.query:
             cnxn.execute(self.query)
+        for sql in self.init_sql:
+            cnxn.execute(sql)
 
         return Connection(cnxn, self.driver)
 
@@ -221,6 +524,7 @@ class ODBC_Engine:
         self.name = cfg.system
         self.host = cfg.host
         self.db_name = db_name
+        self.identity = login_identity(cfg)
         self.odbc_driver_name = self.name if self.name != 'mssql' else 'sql server'
         odbc_driver = self.get_driver()
         self.driver_name = 'pyodbc'
@@ -263,16 +567,20 @@ class ODBC_Engine:
             'database': (config.path if cfg.system == 'sqlite'
                          else db_name.split('.')[0] if db_name else None)
         })
+        # Statements run on every new connection
+        self.init_sql = []
 
     def connect(self):
         cnxn = pyodbc.connect(self.cnxnstr)
         pyodbc.lowercase = False
+        for sql in self.init_sql:
+            cnxn.execute(sql)
         return Connection(cnxn, self.driver)
         # return cnxn
 
     def get_driver(self):
         """Get ODBC driver"""
-        drivers = [d for d in pyodbc.drivers() if self.odbc_driver_name in d.lower()]
+        drivers = [d for d in odbc_drivers() if self.odbc_driver_name in d.lower()]
         drivers.sort(reverse=True, key=lambda x: 'unicode' in x.lower())
 
         try:
@@ -0,0 +1,108 @@
+"""Module for running blocking database work from async handlers"""
+import asyncio
+import contextlib
+import functools
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from settings import Settings
+
+# Status code used by nginx when the client closes the connection
+# before the response is sent
+HTTP_499_CLIENT_CLOSED_REQUEST = 499
+
+
+class DatabaseExecutor:
+    """Runs driver calls in a bounded thread pool
+
+    The event loop is then free to serve other requests while a query
+    runs. The number of threads follows the connection budget, since
+    each running call holds a connection.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='urdr-db')
+        # Waiting for a free connection may block until the pool timeout.
+        # This is done in own threads, so that requests holding
+        # connections always get threads to finish and release them
+        self._checkout_executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='urdr-checkout')
+
+    async def run(self, fn, *args, request=None, cnxn=None, **kwargs):
+        """Run `fn` in thread pool and return the result
+
+        If `request` is given, the call is cancelled when the client
+        disconnects. A running statement is interrupted through `cnxn`,
+        and we wait for the call to finish so that the connection isn't
+        returned to the pool while still in use.
+        """
+        call = functools.partial(fn, *args, **kwargs)
+        cf_future = self._executor.submit(call)
+        future = asyncio.wrap_future(cf_future)
+        if request is None:
+            return await future
+
+        watcher = asyncio.ensure_future(self.wait_for_disconnect(request))
+        done, _ = await asyncio.wait({future, watcher},
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if future in done:
+            watcher.cancel()
+            return future.result()
+
+        # Client has disconnected. Cancel the thread pool future, since
+        # cancelling the asyncio future doesn't wait for a running call
+        if not cf_future.cancel() and cnxn is not None:
+            cnxn.cancel()
+        try:
+            await asyncio.shield(future)
+        except BaseException:
+            pass
+        raise HTTPException(status_code=HTTP_499_CLIENT_CLOSED_REQUEST,
+                            detail="Client closed request")
+
+    async def checkout(self, fn, *args):
+        """Run `fn` getting a connection, outside the database threads"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(fn, *args)
+        return await loop.run_in_executor(self._checkout_executor, call)
+
+    @contextlib.asynccontextmanager
+    async def connection(self, pool):
+        """Check out connection from `pool` for use in async code
+
+        The connection is returned to the pool after use, and rolled
+        back if an exception is raised. This includes cancellation, so
+        the release is shielded and completes even if the task is
+        cancelled while waiting for it.
+        """
+        pool_cnxn = pool.connection()
+        conn = await self.checkout(pool_cnxn.__enter__)
+        try:
+            yield conn
+        finally:
+            release = self._executor.submit(pool_cnxn.__exit__,
+                                            *sys.exc_info())
+            await asyncio.shield(asyncio.wrap_future(release))
+
+    def submit(self, fn, *args, **kwargs):
+        """Run `fn` in thread pool without waiting for the result"""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    async def wait_for_disconnect(self, request):
+        """Return when the client has disconnected
+
+        Must only be used after the request body is read.
+        """
+        while True:
+            message = await request.receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._checkout_executor.shutdown(wait=False, cancel_futures=True)
+
+
+db_executor = DatabaseExecutor(max_workers=Settings().max_connections)
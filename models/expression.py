@@ -1,9 +1,14 @@
 import re
 from datetime import date, datetime
 from settings import drivers, Settings
+from util import Cache
 
 
 cfg = Settings()
+# Named parameter, like `:name`, but not `::` casts
+PARAM_PATTERN = re.compile(r'(?<!:)\:[a-zA-ZæøåÆØÅ_]\w*\b')
+# Compiled statements, with hits and misses counted
+statements = Cache(maxsize=2048)
 
 
 class Expression:
@@ -21,6 +26,130 @@ class Expression:
         else:
             return None
 
+    def schema_fingerprint(self):
+        """Cheap query for token that changes when the schema changes"""
+        if self.dialect == 'sqlite':
+            return "PRAGMA schema_version"
+        elif self.dialect == 'postgresql':
+            # Changes to tables and constraints give new xmin. Renamed
+            # columns and changed types are found from the columns
+            return """
+            select count(*), md5(string_agg(oid::text || xmin::text, ','
+                                            order by oid)),
+                   (select md5(string_agg(concat_ws(':', table_name,
+                                                     column_name, data_type,
+                                                     is_nullable),
+                                          ',' order by table_name,
+                                                       ordinal_position))
+                    from information_schema.columns
+                    where table_schema = :schema_name)
+            from (
+                select c.oid, c.xmin
+                from pg_class c
+                join pg_namespace n on n.oid = c.relnamespace
+                where n.nspname = :schema_name
+                union all
+                select con.oid, con.xmin
+                from pg_constraint con
+                join pg_namespace n on n.oid = con.connamespace
+                where n.nspname = :schema_name
+            ) objects
+            """
+        elif self.dialect in ('mysql', 'mariadb'):
+            # create_time is set when a table is altered, while
+            # update_time is also set when data are changed. Instant
+            # alters don't set create_time, so the column definitions
+            # are summed as checksums, since group_concat is truncated
+            return """
+            select count(*), max(create_time),
+                   (select sum(crc32(concat_ws(':', table_name, column_name,
+                                               ordinal_position, column_type,
+                                               is_nullable)))
+                    from information_schema.columns
+                    where table_schema = :schema_name),
+                   (select count(*) from information_schema.statistics
+                    where table_schema = :schema_name)
+            from information_schema.tables
+            where table_schema = :schema_name
+            """
+        elif self.dialect == 'mssql':
+            return """
+            select count(*), max(modify_date)
+            from sys.objects
+            where schema_id = schema_id(:schema_name)
+            """
+        elif self.dialect == 'duckdb':
+            return """
+            select count(*), md5(string_agg(sql, ';' order by sql))
+            from (
+                select sql from duckdb_tables()
+                union all
+                select sql from duckdb_views() where not internal
+                union all
+                select sql from duckdb_indexes()
+            ) objects
+            """
+        elif self.dialect == 'oracle':
+            return """
+            select count(*), max(last_ddl_time)
+            from all_objects
+            where owner = upper(:schema_name)
+            """
+        else:
+            return None
+
+    def table_rows_estimate(self):
+        """Query for number of rows in table, estimated by the database"""
+        if self.dialect == 'sqlite':
+            # First number in stat is number of rows. Only available
+            # if the database has been analyzed
+            return """
+            select stat from sqlite_stat1
+            where tbl = :table_name
+            limit 1
+            """
+        elif self.dialect == 'postgresql':
+            return """
+            select c.reltuples
+            from pg_class c
+            join pg_namespace n on n.oid = c.relnamespace
+            where n.nspname = :schema_name and c.relname = :table_name
+            """
+        elif self.dialect in ('mysql', 'mariadb'):
+            return """
+            select table_rows
+            from information_schema.tables
+            where table_schema = :schema_name and table_name = :table_name
+            """
+        elif self.dialect == 'mssql':
+            return """
+            select sum(p.rows)
+            from sys.partitions p
+            where p.object_id = object_id(:schema_name + '.' + :table_name)
+            and p.index_id in (0, 1)
+            """
+        elif self.dialect == 'duckdb':
+            return """
+            select estimated_size
+            from duckdb_tables()
+            where table_name = :table_name
+            """
+        elif self.dialect == 'oracle':
+            return """
+            select num_rows
+            from all_tables
+            where owner = upper(:schema_name) and table_name = :table_name
+            """
+        else:
+            return None
+
+    def ping(self):
+        """Cheap statement to check that a connection is alive"""
+        if self.dialect == 'oracle':
+            return "select 1 from dual"
+        else:
+            return "select 1"
+
     def concat(self, items):
         # Concat expressions and treat null as ''
         if self.dialect in ('mysql', 'mariadb'):
@@ -755,6 +884,15 @@ class Expression:
             return """
             select sql from sqlite_master where name = :table_name
             """
+        elif self.dialect == 'postgresql':
+            return """
+            select definition from pg_views
+            where schemaname = :schema_name and viewname = :table_name
+            """
+        elif self.dialect == 'duckdb':
+            return """
+            select sql from duckdb_views() where view_name = :table_name
+            """
         elif self.dialect == 'mssql':
             return """
             select definition
@@ -803,22 +941,12 @@ class Expression:
     def prepare(self, sql, params={}):
         params_prep = params.copy()
         sql_prep = sql
-        driver = drivers[self.engine_name][self.driver_name]
-        if driver['placeholder'] in ('?', '%s'):
+        placeholder = drivers[self.engine_name][self.driver_name]['placeholder']
+        if placeholder in ('?', '%s'):
             if params:
-                p = re.compile(r'(?<!:)\:[a-zA-ZæøåÆØÅ_]\w*\b')
-                placeholders = p.findall(sql)
-                if driver['placeholder'] == '%s':
-                    sql_prep = re.sub(r'(?<!:)\:[a-zA-ZæøåÆØÅ_]\w*\b', '%s', sql)
-                else:
-                    sql_prep = re.sub(r'(?<!:)\:[a-zA-ZæøåÆØÅ_]\w*\b', '?', sql)
+                sql_prep, names = self.compile(sql, placeholder)
                 if type(params) is not list:
-                    params_prep = []
-                    for ph in placeholders:
-                        key = ph[1:]
-                        val = params[key]
-                        params_prep.append(val)
-                    params_prep = tuple(params_prep)
+                    params_prep = tuple(params[name] for name in names)
             else:
                 params_prep = []
         else:
@@ -828,4 +956,20 @@ class Expression:
 
         return sql_prep, params_prep
 
+    def compile(self, sql, placeholder):
+        """Rewrite named parameters in `sql` to positional placeholder
+
+        Returns the rewritten sql and the parameter names in order.
+        Results are cached, as the same statements are prepared over
+        and over.
+        """
+        key = (sql, placeholder)
+        compiled = statements.get(key)
+        if compiled is None:
+            names = tuple(ph[1:] for ph in PARAM_PATTERN.findall(sql))
+            compiled = (PARAM_PATTERN.sub(placeholder, sql), names)
+            statements.set(key, compiled)
+
+        return compiled
+
 
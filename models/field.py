@@ -5,6 +5,14 @@ import util
 from settings import Settings
 
 cfg = Settings()
+# Options for fields, keyed by source table, field and condition
+option_lists = util.Cache(maxsize=1024, ttl=cfg.options_ttl)
+
+
+def invalidate_options(engine, schema, table):
+    """Remove cached options taken from `table`, after writes to it"""
+    option_lists.invalidate(lambda key: key[:4] == (engine.host, engine.db_name,
+                                                    schema, table))
 
 
 class Field:
@@ -123,16 +131,13 @@ class Field:
 
         return attributes
 
-    def get_options(self, condition, params, get_parent=True):
-        from models.table import Table
-
-        q = self._db.expr.quote
+    def options_source(self, get_parent=True):
+        """Return table and columns that options are taken from"""
         fkey = self._tbl.get_fkey(self.name)
-
-        parent = 'NULL'
+        src = Dict({'fkey': None, 'parent': 'NULL'})
 
         if fkey and fkey.referred_table in self._db.tablenames:
-            ref_tbl = Table(self._db, fkey.referred_table)
+            ref_tbl = self._db.table(fkey.referred_table)
             hierarchy = False
             for rel in ref_tbl.relations.values():
                 if rel.table_name == ref_tbl.name:
@@ -141,47 +146,76 @@ class Field:
 
             if hierarchy and get_parent:
                 fkey_parent = ref_tbl.get_parent_fk()
-                parent = fkey_parent.constrained_columns[-1]
+                src.parent = fkey_parent.constrained_columns[-1]
 
-            from_table = fkey.referred_table
-            pkey_col = fkey.referred_columns[-1]
-            alias = fkey.ref_table_alias
-            select = 'count(*)'
+            src.fkey = fkey
+            src.table = fkey.referred_table
+            src.pkey_col = fkey.referred_columns[-1]
+            src.alias = fkey.ref_table_alias
+            src.select = 'count(*)'
         else:
-            from_table = self._tbl.name
-            pkey_col = self.name
-            alias = self.name
-            select = f'count(distinct {pkey_col})'
+            src.table = self._tbl.name
+            src.pkey_col = self.name
+            src.alias = self.name
+            src.select = f'count(distinct {src.pkey_col})'
 
-        # Field that holds the value of the options
-        value_field = f'{q(alias)}.' + q(pkey_col)
+        return src
 
-        condition = condition or '1=1'
-
-        # Count records
-
-        sql = f"""
-        select {select}
-        from {self._db.schema}.{from_table} {alias}
+    def options_key(self, src, condition, params):
+        """Return key for options in cache"""
+        engine = self._db.engine
+        return (engine.host, engine.db_name, self._db.schema, src.table,
+                engine.identity, self._tbl.name, self.name, src.parent,
+                condition, tuple(sorted(params.items())))
+
+    def count_options_sql(self, src, condition):
+        """Return sql that counts options"""
+        return f"""
+        select {src.select}
+        from {self._db.schema}.{src.table} {src.alias}
         where {condition}
         """
 
-        with self._db.cnxn.cursor() as crsr:
-            sql, params1 = self._db.expr.prepare(sql, params)
-            crsr.execute(sql, params1)
-            count = crsr.fetchone()[0]
+    def get_options(self, condition, params, get_parent=True, count=None):
+        """Return options for field, or False if more than 100
 
-        if (count > 100):
+        Options are cached, and `count` may be given if the options
+        are already counted.
+        """
+        q = self._db.expr.quote
+        src = self.options_source(get_parent)
+        condition = condition or '1=1'
+        key = self.options_key(src, condition, params)
+        options = option_lists.get(key)
+
+        if options is None and count is None:
+            with self._db.cnxn.cursor() as crsr:
+                sql, params1 = self._db.expr.prepare(
+                    self.count_options_sql(src, condition), params)
+                crsr.execute(sql, params1)
+                count = crsr.fetchone()[0]
+
+        if options is None and count > 100:
+            option_lists.set(key, False)
+            return False
+        elif options is False:
             return False
 
-        view = None if not fkey else self.get_view(fkey)
+        view = None if not src.fkey else self.get_view(src.fkey)
         self.view = view if view else self.name
 
+        if options is not None:
+            # Copies, since callers may change the options
+            return [Dict(option) for option in options]
+
+        # Field that holds the value of the options
+        value_field = f'{q(src.alias)}.' + q(src.pkey_col)
+
         sql = f"""
         select distinct {value_field} as value,
                {self.view or value_field} as label,
-               {parent} as parent
-        from   {self._db.schema}.{q(from_table)} {q(alias)}
+               {src.parent} as parent
+        from   {self._db.schema}.{q(src.table)} {q(src.alias)}
         where  {condition}
         order by {self.view or value_field}
         """
@@ -193,21 +227,24 @@ class Field:
 
             # Return list of regular python dicts so that it can be
             # json serialized and put in cache
-            return [util.to_rec(row, crsr) for row in rows]
+            options = util.to_recs(rows, crsr)
+
+        option_lists.set(key, options)
+
+        return [Dict(option) for option in options]
 
     def get_view(self, fkey):
         """ Decide what should be shown in options """
         q = self._db.expr.quote
         if hasattr(self, 'view'):
             return self.view
-        from models.table import Table
 
         self.view = None
         engine = self._db.engine
 
         if fkey.referred_table in self._db.tablenames:
 
-            ref_tbl = Table(self._db, fkey.referred_table)
+            ref_tbl = self._db.table(fkey.referred_table)
             self.view = q(fkey.ref_table_alias) + '.' + q(fkey.referred_columns[-1])
 
             if ref_tbl.is_hidden() is False and ref_tbl.type != 'list':
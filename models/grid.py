@@ -1,5 +1,8 @@
 import re
 import math
+import json
+import base64
+import hashlib
 from addict import Dict
 import util
 from settings import Settings
@@ -7,6 +10,29 @@ from models.expression import Expression
 
 cfg = Settings()
 
+# Grid responses, for users paging back and forth in the same grids
+grid_results = util.Cache(maxsize=256, ttl=cfg.grid_ttl)
+# Footer sums, shared by all pages of grids with the same conditions
+grid_sums = util.Cache(maxsize=256, ttl=cfg.sums_ttl)
+# Number of children for each row in hierarchic tables
+child_counts = util.Cache(maxsize=64, ttl=cfg.sums_ttl)
+
+
+def invalidate_grids(engine, tables=None):
+    """Remove cached grids showing `tables`, after writes to them"""
+    def predicate(key):
+        return (key[:2] == (engine.host, engine.db_name) and
+                (tables is None or key[2] in tables))
+
+    grid_results.invalidate(predicate)
+    grid_sums.invalidate(predicate)
+    child_counts.invalidate(predicate)
+
+
+def grid_etag(body):
+    """Return entity tag for encoded grid response"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
 
 class Grid:
     """Contains methods for returning metadata and data for grid"""
@@ -20,8 +46,15 @@ class Grid:
             'stmnts': []
         })
         self.compressed = False
+        # Send records as one list per column
+        self.columnar = False
         self.access_check = False
         self.is_relation = False
+        # Token from client for keyset pagination
+        self.cursor = None
+        self.cursors = Dict()
+        # Key of selected row, and its index in the page
+        self.selected = None
 
     def get(self, pkey_vals=None):
         """Return all metadata and data to display grid"""
@@ -29,14 +62,13 @@ class Grid:
         # Cahe metadata
         self.db.indexes
 
-        schema_names = self.db.refl.get_schema_names()
-
         return Dict({
             'name': self.tbl.name,
             'type': self.tbl.type,
             'selection': self.get_selected_idx(pkey_vals),
             'records': self.get_records(),
             'count_records': self.get_rowcount(),
+            'count_exact': self.count_exact,
             'fields': self.tbl.fields,
             'grid': {
                 'columns': self.columns,
@@ -55,11 +87,12 @@ class Grid:
             'actions': self.actions,
             'limit': self.tbl.limit,
             'offset': self.tbl.offset,
+            'cursors': self.cursors,
             'conditions': self.cond.stmnts,
             'expansion_column': self.get_expansion_column(),
             'relations': self.tbl.relations,
-            'fts': self.tbl.name + '_fts' in self.db.tablenames or
-                f'{self.db.cat}.fts_{self.db.schema}_{self.tbl.name}' in schema_names,
+            'fts': (self.tbl.name + '_fts' in self.db.tablenames or
+                    bool(self.db.fts_schema(self.tbl.name))),
             'saved_filters': []  # Needed in frontend
         })
 
@@ -70,10 +103,14 @@ class Grid:
         for col in self.tbl.pkey.columns:
             selects[col] = f'{self.tbl.view}.{col}'
 
-        expansion_column = self.get_expansion_column()
-        if expansion_column:
+        # Children are counted for all rows in one query if the parent
+        # key is selected, else by subquery for each row
+        fkey = None
+        if self.get_expansion_column():
             fkey = self.tbl.get_parent_fk()
-            selects['count_children'] = self.select_children_count(fkey)
+            if not set(fkey.referred_columns) <= set(self.tbl.pkey.columns):
+                selects['count_children'] = self.select_children_count(fkey)
+                fkey = None
 
         if self.actions:
             for key, action in self.actions.items():
@@ -87,33 +124,145 @@ class Grid:
             col.tbl = self.tbl.grid_view
             selects[colname] = self.db.expr.column(col)
 
-        display_values = self.get_display_values(selects)
+        keys = self.sort_keys()
+        cursor = self.decode_cursor(keys)
+        if cursor:
+            rows = self.get_rows(selects, keys, seek=cursor)
+        elif self.selected:
+            # Rows before and from the selected row
+            key_vals, row_idx = self.selected
+            rows = []
+            if row_idx:
+                rows = self.get_rows(selects, keys, limit=row_idx,
+                                     seek=(key_vals, 'prev', False))
+            rows += self.get_rows(selects, keys,
+                                  limit=self.tbl.limit - row_idx,
+                                  seek=(key_vals, 'next', True))
+        else:
+            rows = self.get_rows(selects, keys)
+
+        if fkey:
+            counts = self.get_children_counts(fkey, rows)
+            for display, values, _ in rows:
+                parent = tuple(values[col] for col in fkey.referred_columns)
+                display['count_children'] = counts.get(parent, 0)
+
+        if keys and rows:
+            self.cursors.prev = self.make_cursor(rows[0][2], 'prev')
+            self.cursors.next = self.make_cursor(rows[-1][2], 'next')
+
+        pkey_cols = self.tbl.pkey.columns or self.columns
+        if self.columnar:
+            return self.make_columnar(rows, pkey_cols)
 
-        values = self.get_values(selects)
         recs = []
-        for row in display_values:
-            cols = {k: {'text': text} for k, text in row.items()}
-            if 'count_children' in row:
+        for display, values, _ in rows:
+            cols = {k: {'text': text} for k, text in display.items()}
+            if 'count_children' in display:
                 recs.append({
-                    'count_children': row['count_children'],
+                    'count_children': display['count_children'],
                     'columns': cols
                 })
             else:
                 recs.append({'columns': cols})
 
-        for index, row in enumerate(values):
-            for col, val in row.items():
-                recs[index]['columns'][col]['value'] = val
-            cols = self.tbl.pkey.columns or self.columns
-            recs[index]['pkey'] = {key: row[key] for key in cols}
+            for col, val in values.items():
+                cols[col]['value'] = val
+            recs[-1]['pkey'] = {key: values[key] for key in pkey_cols}
+
+        return recs
+
+    def make_columnar(self, rows, pkey_cols):
+        """Return records with a list of values and texts for each column
+
+        Texts are left out for columns where they equal the values,
+        and the primary key is given by the names of its columns.
+        """
+        recs = Dict({'length': len(rows), 'pkey': pkey_cols, 'columns': {}})
+        if not rows:
+            return recs
+
+        for key in rows[0][0]:
+            texts = [display[key] for display, _, _ in rows]
+            if key == 'count_children':
+                recs.count_children = texts
+                continue
+            col = {}
+            if key in rows[0][1]:
+                col['value'] = [values[key] for _, values, _ in rows]
+                if texts != col['value']:
+                    col['text'] = texts
+            else:
+                col['text'] = texts
+            recs.columns[key] = col
 
         return recs
 
     def get_selected_idx(self, pkey_vals):
-        """Return rowindex for record selected in frontend"""
+        """Return rowindex for record selected in frontend
+
+        The position of the record is found by counting the rows
+        ordered before it, which may use the index for the sorting.
+        """
         if not pkey_vals:
             return None
 
+        keys = self.sort_keys()
+        if not keys:
+            return self.get_selected_rownum(pkey_vals)
+
+        q = Expression(self.db.engine).quote
+        self.set_access_cond()
+
+        sql = self.db.cte_access if self.access_check else ''
+        select = ', '.join(expr for expr, _ in keys)
+        join = '\n'.join(self.tbl.joins.values())
+        conds = [f'{q(self.tbl.view)}.{q(colname)} = :{colname}'
+                 for colname in pkey_vals]
+        if self.cond.prep_stmnts:
+            conds.append(self.get_cond_expr())
+        sql += f"""
+        select {select}
+        from   {self.db.schema}.{q(self.tbl.view)}
+        {join}
+        where  {' and '.join(conds)}
+        """
+
+        sql, params = self.db.expr.prepare(sql, self.cond.params | pkey_vals)
+        with self.db.cnxn.cursor() as crsr:
+            crsr.execute(sql, params)
+            row = crsr.fetchone()
+        if row is None:
+            return 0
+
+        key_vals = list(row)
+        seek_cond, seek_params = self.seek_cond(keys, key_vals, 'prev')
+        conds = [seek_cond]
+        if self.cond.prep_stmnts:
+            conds.append(self.get_cond_expr())
+
+        sql = self.db.cte_access if self.access_check else ''
+        sql += f"""
+        select count(*)
+        from   {self.db.schema}.{q(self.tbl.view)}
+        {join}
+        where  {' and '.join(conds)}
+        """
+
+        sql, params = self.db.expr.prepare(sql, self.cond.params | seek_params)
+        with self.db.cnxn.cursor() as crsr:
+            crsr.execute(sql, params)
+            idx = crsr.fetchone()[0]
+
+        page_nr = math.floor(idx / self.tbl.limit)
+        self.tbl.offset = page_nr * self.tbl.limit
+        row_idx = idx - self.tbl.offset
+        self.selected = (key_vals, row_idx)
+
+        return row_idx
+
+    def get_selected_rownum(self, pkey_vals):
+        """Return rowindex for selected record, using row_number()"""
         prep_stmnts = []
         params = {}
         for colname, value in pkey_vals.items():
@@ -178,6 +327,61 @@ class Grid:
 
         return sql
 
+    def get_children_counts(self, fkey, rows):
+        """Return number of children for rows, by values of parent key
+
+        Counts for the whole table are cached if `cache_child_counts`
+        is set in Settings, else counted for the rows of the page.
+        """
+        if cfg.cache_child_counts:
+            key = (self.db.engine.host, self.db.engine.db_name,
+                   self.tbl.name, self.db.schema)
+            return child_counts.get_or_set(
+                key, lambda: self.count_children(fkey))
+
+        parents = {tuple(values[col] for col in fkey.referred_columns)
+                   for _, values, _ in rows}
+        parents = [parent for parent in parents if None not in parent]
+        if not parents:
+            return {}
+
+        return self.count_children(fkey, parents)
+
+    def count_children(self, fkey, parents=None):
+        """Count children of `parents` in one grouped query
+
+        Counts children of all rows in table if `parents` is None.
+        """
+        q = Expression(self.db.engine).quote
+        cols = [q(col) for col in fkey.constrained_columns]
+        params = {}
+        conds = []
+        for i, parent in enumerate(parents or []):
+            ands = []
+            for j, col in enumerate(cols):
+                params[f'parent_{i}_{j}'] = parent[j]
+                ands.append(f'{col} = :parent_{i}_{j}')
+            conds.append(' and '.join(ands))
+
+        sql = f"select {', '.join(cols)}, count(*)\n"
+        sql += f"from {self.db.schema}.{q(self.tbl.name)}\n"
+        if len(cols) == 1 and conds:
+            marks = ', '.join(f':{param}' for param in params)
+            sql += f"where {cols[0]} in ({marks})\n"
+        elif conds:
+            sql += "where (" + ') or ('.join(conds) + ")\n"
+        else:
+            sql += "where " + ' and '.join(f'{col} is not null'
+                                           for col in cols) + "\n"
+        sql += f"group by {', '.join(cols)}"
+
+        with self.db.cnxn.cursor() as crsr:
+            sql, params = self.db.expr.prepare(sql, params)
+            crsr.execute(sql, params)
+            rows = crsr.fetchall()
+
+        return {tuple(row[:-1]): row[-1] for row in rows}
+
     def get_expansion_column(self):
         """Return column that defines a hierarchic table"""
         for rel in self.tbl.relations.values():
@@ -299,8 +503,16 @@ class Grid:
 
         return self._columns
 
-    def make_order_by(self):
-        """Return 'order by'-clause"""
+    def make_order_by(self, keys=None, reverse=False):
+        """Return 'order by'-clause
+
+        Rows are ordered by `keys` from `sort_keys` if given, in
+        reverse order for paging backwards.
+        """
+        if keys:
+            dirs = {'ASC': 'DESC', 'DESC': 'ASC'} if reverse else {}
+            return "order by " + ', '.join(f'{expr} {dirs.get(dir, dir)}'
+                                           for expr, dir in keys)
 
         q = Expression(self.db.engine).quote
         order = "order by "
@@ -332,49 +544,66 @@ class Grid:
 
         return order
 
-    def get_values(self, selects):
-        """Return values for columns in grid"""
-        q = Expression(self.db.engine).quote
-        cols = []
-        for key, value in selects.items():
-            field = self.tbl.fields[key]
-            if (
-                (key in self.tbl.fields or key == 'rowid') and
-                'source' not in field
-            ):
-                cols.append(f'{value} as {q(key)}')
-
-        sql = ''
-        if self.access_check:
-            sql += self.db.cte_access
-
-        select = ', '.join(cols)
-        cond = self.get_cond_expr()
-        order = self.make_order_by()
-
-        sql += "select " + select + "\n"
-        sql += f'from {self.db.schema}.{q(self.tbl.view)}\n'
-        sql += '\n'.join(self.tbl.joins.values())
-        sql += "" if not cond else "\nwhere " + cond + "\n"
-        sql += '\n' + order + "\n"
+    def get_rowcount(self, exact=False):
+        """Return rowcount for grid
 
-        if self.db.engine.name in ['mssql', 'oracle']:
-            sql += f"offset {self.tbl.offset} rows\n"
-            sql += f"fetch next {self.tbl.limit} rows only"
-        else:
-            sql += f"limit {self.tbl.limit} offset {self.tbl.offset}"
+        Unless `exact`, the count is estimated by the database for
+        grids showing whole tables, and counted only up to
+        `count_limit` in Settings for filtered grids. Sets
+        `count_exact` to tell if the count is exact.
+        """
+        self.count_exact = True
+        if exact:
+            return self.count_rows()
+
+        limit = cfg.count_limit
+        if (
+            not self.cond.prep_stmnts and not self.access_check and
+            self.tbl.view == self.tbl.name and
+            self.tbl.grid_view not in self.tbl.joins and
+            self.tbl.name + '_fts' not in self.tbl.joins
+        ):
+            estimate = self.estimate_rowcount()
+            if estimate is not None and estimate >= limit:
+                self.count_exact = False
+                return estimate
+
+        count = self.count_rows(limit + 1)
+        if count > limit:
+            # Tells that there are at least `limit` rows
+            self.count_exact = False
+            count = limit
 
-        with self.db.cnxn.cursor() as crsr:
-            sql, params = self.db.expr.prepare(sql, self.cond.params)
-            crsr.execute(sql, params)
-            rows = crsr.fetchall()
-            records = [util.to_rec(row, crsr) for row in rows]
+        return count
 
-        return records
+    def estimate_rowcount(self):
+        """Return number of rows in table estimated by the database"""
+        sql = self.db.expr.table_rows_estimate()
+        if not sql:
+            return None
+        try:
+            with self.db.cnxn.cursor() as crsr:
+                sql, params = self.db.expr.prepare(sql, {
+                    'schema_name': self.db.schema,
+                    'table_name': self.tbl.name
+                })
+                crsr.execute(sql, params)
+                row = crsr.fetchone()
+        except Exception:
+            # E.g. sqlite_stat1 is missing, or the connection has
+            # no access to the catalog
+            self.db.cnxn.rollback()
+            return None
+        if row is None or row[0] is None:
+            return None
+        estimate = int(str(row[0]).split()[0]) if isinstance(row[0], str) \
+            else int(row[0])
 
-    def get_rowcount(self):
-        """Return rowcount for grid"""
+        # Postgres returns -1 for tables never analyzed
+        return estimate if estimate >= 0 else None
 
+    def count_rows(self, limit=None):
+        """Count rows in grid, but no more than `limit`"""
         q = Expression(self.db.engine).quote
         conds = self.get_cond_expr()
 
@@ -382,17 +611,22 @@ class Grid:
         if self.access_check:
             sql += self.db.cte_access
 
-        if self.db.engine.name == 'sqlite':
-            sql += "select * \n"
-        else:
-            sql += "select count(*)\n"
+        select = "select count(*)\n"
+        if limit and self.db.engine.name == 'mssql':
+            select = f"select top {limit} 1 as one\n"
+        elif limit:
+            select = "select 1 as one\n"
+        sql += select
         sql += f'from {self.db.schema}.{q(self.tbl.view)}\n'
         sql += '\n'.join(self.tbl.joins.values()) + "\n"
         sql += "" if not conds else f"where {conds}\n"
 
-        # Counting can very slow in SQLite, so we limit to 1000
-        if self.db.engine.name == 'sqlite':
-            sql = f"select count(*) from (\n{sql}\nlimit 1000)"
+        if limit and self.db.engine.name == 'oracle':
+            sql += f"fetch first {limit} rows only\n"
+        elif limit and self.db.engine.name != 'mssql':
+            sql += f"limit {limit}\n"
+        if limit:
+            sql = f"select count(*) from (\n{sql}\n) limited"
 
         with self.db.cnxn.cursor() as crsr:
             sql, params = self.db.expr.prepare(sql, self.cond.params)
@@ -401,25 +635,88 @@ class Grid:
 
         return count
 
-    def get_display_values(self, selects):
-        """Return display values for columns in grid"""
-
-        from models.table import Table
+    def sort_keys(self):
+        """Return expressions and directions that rows are ordered by
 
+        Primary key columns are added, so that the order is unique as
+        needed for keyset pagination. Returns None if the rows can't
+        be paged by key, e.g. when sorting on nullable columns, since
+        nulls are ordered differently in the database systems.
+        """
         q = Expression(self.db.engine).quote
+        if not self.tbl.pkey.columns or 'rank' in self.sort_columns:
+            return None
 
-        alias_selects = {}
-        for key, value in selects.items():
-            field = self.tbl.fields[key]
-            alias_selects[key] = f'{field.view or value} as {q(key)}'
-        select = ', '.join(alias_selects.values())
+        keys = []
+        for sort in self.sort_columns.values():
+            field = self.tbl.fields[sort.col]
+            if field.nullable is not False or (field.fkey and not self.compressed):
+                return None
+            if sort.col in self.tbl.fields and not field.virtual:
+                tbl_name = self.tbl.view
+            else:
+                tbl_name = self.tbl.name + '_grid'
+            keys.append((f'{tbl_name}.{sort.col}', sort.dir.upper()))
+
+        for col in self.tbl.pkey.columns:
+            keys.append((f'{q(self.tbl.view)}.{q(col)}', 'ASC'))
+
+        return keys
+
+    def seek_cond(self, keys, values, direction, inclusive=False):
+        """Return condition and params for rows after or before key
+
+        `direction` is 'next' for rows after the key, and 'prev'
+        for rows before.
+        """
+        ors = []
+        params = {}
+        for i, (expr, dir) in enumerate(keys):
+            op = '>' if (dir == 'ASC') == (direction == 'next') else '<'
+            ands = [f'{keys[j][0]} = :seek{j}' for j in range(i)]
+            ands.append(f'{expr} {op} :seek{i}')
+            ors.append('(' + ' and '.join(ands) + ')')
+            params[f'seek{i}'] = values[i]
+        if inclusive:
+            ands = [f'{expr} = :seek{i}' for i, (expr, _) in enumerate(keys)]
+            ors.append('(' + ' and '.join(ands) + ')')
+
+        return '(' + ' or '.join(ors) + ')', params
+
+    def make_cursor(self, values, direction):
+        """Return token for fetching rows after or before key"""
+        data = json.dumps({'key': values, 'dir': direction}, default=str)
+
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, keys):
+        """Return seek from cursor token, if valid for the sorting"""
+        if not self.cursor or not keys:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(self.cursor))
+        except ValueError:
+            return None
+        if (
+            len(data.get('key', [])) != len(keys) or
+            data.get('dir') not in ('next', 'prev')
+        ):
+            return None
+
+        return (data['key'], data['dir'], False)
+
+    def set_access_cond(self):
+        """Add conditions to show only rows user has access to"""
+        if hasattr(self, '_access_cond_set'):
+            return
+        self._access_cond_set = True
+        # Access codes are found only if the table has access indexes
+        if not self.db.access_schema:
+            return
 
-        sql = ''
         access_idx = self.tbl.get_access_code_idx()
-        if access_idx and self.db.cte_access:
+        if access_idx:
             self.access_check = True
-            sql += self.db.cte_access
-            self.cond.params.uid = self.db.user.name
             for col in access_idx.columns:
                 col = access_idx.table_alias + '.' + col
                 stmt = f'({col} IS NULL or {col} in (select code from cte_access))'
@@ -427,13 +724,10 @@ class Grid:
 
         # Check access for foreign keys
         for key, fkey in self.tbl.fkeys.items():
-            fkey_table = Table(self.db, fkey.referred_table)
+            fkey_table = self.db.table(fkey.referred_table)
             fkey_access_idx = fkey_table.get_access_code_idx()
-            if fkey_access_idx and self.db.cte_access:
+            if fkey_access_idx:
                 self.access_check = True
-                if 'cte_access' not in sql:
-                    sql += self.db.cte_access
-                    self.cond.params.uid = self.db.user.name
                 for col in fkey_access_idx.columns:
                     if fkey_access_idx.table_name == fkey.referred_table:
                         alias = fkey.ref_table_alias
@@ -443,8 +737,59 @@ class Grid:
                     stmt = f'({col} IS NULL or {col} in (select code from cte_access))'
                     self.cond.prep_stmnts.append(stmt)
 
-        order = self.make_order_by()
+        if self.access_check:
+            self.cond.params.update(self.db.access_params)
+
+    def get_rows(self, selects, keys=None, seek=None, limit=None):
+        """Return display values, values and keys for rows in grid page
+
+        All are selected in one query, and returned as a tuple for
+        each row. Rows are found by offset, or after or before the
+        key in `seek` if given.
+        """
+        q = Expression(self.db.engine).quote
+        limit = self.tbl.limit if limit is None else limit
+
+        alias_selects = {}
+        for key, value in selects.items():
+            field = self.tbl.fields[key]
+            alias_selects[key] = f'{field.view or value} as {q(key)}'
+
+        # Values are selected after display values, with own aliases
+        value_selects = {}
+        for key, value in selects.items():
+            field = self.tbl.fields[key]
+            if (
+                (key in self.tbl.fields or key == 'rowid') and
+                'source' not in field
+            ):
+                alias = f'value_{len(value_selects)}'
+                value_selects[key] = f'{value} as {q(alias)}'
+        select = ', '.join(list(alias_selects.values()) +
+                           list(value_selects.values()))
+
+        # Key values are selected last
+        key_selects = [f'{expr} as {q(f"sort_key_{i}")}'
+                       for i, (expr, _) in enumerate(keys or [])]
+        if key_selects:
+            select += ', ' + ', '.join(key_selects)
+
+        self.set_access_cond()
+        sql = self.db.cte_access if self.access_check else ''
+
+        params = self.cond.params
         conds = self.get_cond_expr()
+        offset = self.tbl.offset
+        reverse = False
+        if seek:
+            key_vals, direction, inclusive = seek
+            seek_cond, seek_params = self.seek_cond(keys, key_vals, direction,
+                                                    inclusive)
+            conds = seek_cond if not conds else conds + ' and ' + seek_cond
+            params = params | seek_params
+            offset = 0
+            reverse = direction == 'prev'
+        order = self.make_order_by(keys, reverse=reverse)
 
         sql += "select " + select + "\n"
         sql += f'from {self.db.schema}.{q(self.tbl.view)}\n'
@@ -453,56 +798,82 @@ class Grid:
         sql += '\n' + order + "\n"
 
         if self.db.engine.name in ['mssql', 'oracle']:
-            sql += f"offset {self.tbl.offset} rows\n"
-            sql += f"fetch next {self.tbl.limit} rows only"
+            sql += f"offset {offset} rows\n"
+            sql += f"fetch next {limit} rows only"
         else:
-            sql += f"limit {self.tbl.limit} offset {self.tbl.offset}"
+            sql += f"limit {limit} offset {offset}"
 
         with self.db.cnxn.cursor() as crsr:
-            sql, params = self.db.expr.prepare(sql, self.cond.params)
+            sql, params = self.db.expr.prepare(sql, params)
             crsr.execute(sql, params)
             rows = crsr.fetchall()
-            records = [util.to_rec(row, crsr) for row in rows]
 
-        return records
+        if reverse:
+            rows.reverse()
+
+        n = len(alias_selects)
+        m = n + len(value_selects)
+        return [(Dict(zip(alias_selects, row[:n])),
+                 Dict(zip(value_selects, row[n:m])),
+                 list(row[m:]))
+                for row in rows]
 
     def get_sums(self):
-        """Return list of sums for summation columns"""
-        sums = {}
+        """Return sums for summation columns
 
-        if (self.tbl.name + '_footer') in self.db.tablenames:
-            view_name = self.tbl.name + '_footer'
-            view_def = (self.db.refl
-                        .get_view_definition(view_name, self.db.schema))
-            index = view_def.lower().index(view_name + ' as') + len(view_name) + 3
-            view_def = view_def[index:]
-        else:
-            return sums
+        The sums are selected by the view `<table>_footer`, and are
+        cached for the conditions of the grid, so that paging through
+        the grid doesn't run the aggregate again.
+        """
+        view_name = self.tbl.name + '_footer'
+        if view_name not in self.db.refl.tables(self.db.schema):
+            return {}
 
         cond = self.get_cond_expr()
-        joins = [join for join in self.tbl.joins.values()
-                 if self.tbl.name + '_grid' not in join]
+        key = (self.db.engine.host, self.db.engine.db_name, self.tbl.name,
+               self.db.schema, self.db.engine.identity, cond,
+               json.dumps(self.cond.params, sort_keys=True, default=str))
 
-        if (self.tbl.name + '_grid') in self.db.tablenames:
-            join = "join " + self.tbl.name + " on "
-            ons = [f'{self.tbl.grid_view}.{col} = {self.tbl.view}.{col}'
-                   for col in self.tbl.pkey.columns]
-            join += ' AND '.join(ons) + "\n"
-        else:
-            join = ""
+        return grid_sums.get_or_set(key, lambda: self.select_sums(view_name,
+                                                                   cond))
 
-        joins.insert(0, join)
+    def select_sums(self, view_name, cond):
+        """Run query from footer view with conditions of grid"""
+        q = Expression(self.db.engine).quote
+        view_def = self.db.refl.get_view_definition(view_name, self.db.schema)
+        if not view_def:
+            return {}
+
+        # Keep only the select statement from `create view ... as`
+        match = re.match(r'\s*create\s+(or\s+replace\s+)?view\s+.*?\s+as\s+',
+                         view_def, re.IGNORECASE | re.DOTALL)
+        if match:
+            view_def = view_def[match.end():]
+        view_def = view_def.strip().rstrip(';')
+
+        # The footer view selects from the grid view if it exists,
+        # which is then joined with the table to use the grid conditions
+        joins = [join for name, join in self.tbl.joins.items()
+                 if name != self.tbl.grid_view]
+        if self.tbl.grid_view != self.tbl.view:
+            ons = [f'{q(self.tbl.grid_view)}.{q(col)} = '
+                   f'{q(self.tbl.view)}.{q(col)}'
+                   for col in self.tbl.pkey.columns]
+            joins.insert(0, f'join {self.db.schema}.{q(self.tbl.view)} on ' +
+                         ' and '.join(ons))
 
-        sql = view_def + '\n'
+        sql = self.db.cte_access if self.access_check else ''
+        sql += view_def + '\n'
         sql += '\n'.join(joins) + "\n"
         sql += '' if not cond else "where " + cond + "\n"
 
+        sums = {}
         with self.db.cnxn.cursor() as crsr:
             sql, params = self.db.expr.prepare(sql, self.cond.params)
-            row = crsr.execute(sql, params).fechone()
-            rec = util.to_rec(row, crsr)
-
+            crsr.execute(sql, params)
+            row = crsr.fetchone()
             if row:
+                rec = util.to_rec(row, crsr)
                 for col in rec:
                     if col not in self.tbl.pkey.columns:
                         sums[col] = rec[col]
@@ -540,11 +911,9 @@ class Grid:
 
     def set_search_cond(self, query):
         """Set search conditions for grid queries"""
-        from models.table import Table
         engine = self.db.engine
         q = Expression(engine).quote
         filters = query.split(";")
-        schema_names = self.db.refl.get_schema_names()
         for fltr in filters:
             parts = re.split(r"\s*([=<>]|!=| IN| LIKE|NOT LIKE|"
                              r"IS NULL|IS NOT NULL)\s*", fltr, 2)
@@ -552,10 +921,11 @@ class Grid:
                 # Simple search in any text field
                 conds = []
                 params = {}
-                duck_fts_table = f"fts_{self.db.schema}_{self.tbl.name}"
+                duck_fts_table = self.db.fts_schema(self.tbl.name)
                 if self.tbl.name + '_fts' in self.db.tablenames:
                     fts = self.tbl.name + '_fts'
-                    sql = f"{fts} match '{fltr}'"
+                    sql = f"{fts} match :fts_query"
+                    params['fts_query'] = fltr
                     self.tbl.fts = True
                     conds.append(sql)
                     if len(self.sort_columns) == 0:
@@ -564,14 +934,15 @@ class Grid:
                             'dir': 'asc',
                             'idx': 0
                         })
-                elif f'{self.db.cat}.{duck_fts_table}' in schema_names:
+                elif duck_fts_table:
                     col = self.tbl.pkey.columns[0]
-                    sql = f"{duck_fts_table}.match_bm25({col}, '{fltr}') IS NOT NULL"
+                    sql = f"{duck_fts_table}.match_bm25({col}, :fts_query) IS NOT NULL"
+                    params['fts_query'] = fltr
                     conds.append(sql)
                     self.tbl.fts = True
                     if len(self.sort_columns) == 0:
                         self.sort_columns['rank'] = Dict({
-                            'col': f"{duck_fts_table}.match_bm25({col}, '{fltr}')",
+                            'col': f"{duck_fts_table}.match_bm25({col}, :fts_query)",
                             'dir': 'asc',
                             'idx': 0
                         })
@@ -639,14 +1010,14 @@ class Grid:
                         field = None
                         for fkey in self.tbl.fkeys.values():
                             if fkey.ref_table_alias == tbl_alias:
-                                tbl = Table(self.db, fkey.referred_table)
+                                tbl = self.db.table(fkey.referred_table)
                                 field = tbl.fields[field_name]
                         for fkey in self.tbl.relations.values():
                             if fkey.relationship == '1:1':
                                 prefix = fkey.referred_table.rstrip('_') + '_'
                                 alias = fkey.table_name.replace(prefix, '')
                                 if alias == tbl_alias:
-                                    tbl = Table(self.db, fkey.table_name)
+                                    tbl = self.db.table(fkey.table_name)
                                     field = tbl.fields[field_name]
 
                 operator = parts[1].strip()
@@ -810,12 +1181,10 @@ class Grid:
 
     def relations_form(self, form):
         """Add relations to form"""
-        from models.table import Table
-
         relations = Dict()
         for alias, rel in self.tbl.relations.items():
             rel.order = 10
-            rel_tbl = Table(self.db, rel.table_name)
+            rel_tbl = self.db.table(rel.table_name)
 
             # Remove relations that are extensions to other tables
             # and where constrained columns is a sublist of pkey column
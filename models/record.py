@@ -2,7 +2,8 @@ import os
 import hashlib
 from addict import Dict
 from datetime import datetime
-from models.field import Field
+from models.field import Field, invalidate_options
+from models.grid import invalidate_grids
 from models.column import Column
 from models.expression import Expression
 import util
@@ -27,6 +28,16 @@ class Record:
 
         return formatted_pkey
 
+    def invalidate_caches(self):
+        """Remove cached options and grids affected by writes to record"""
+        invalidate_options(self._db.engine, self._db.schema, self._tbl.name)
+        # Grids of related tables show values from this table
+        tables = [self._tbl.name]
+        tables.extend(rel.table_name for rel in self._tbl.relations.values())
+        invalidate_grids(self._db.engine, tables)
+        # DuckDB full-text indexes are not updated by writes
+        self._db.schedule_fts_refresh(self._tbl.name)
+
     def get(self):
         # Cache metadata
         self._db.indexes
@@ -83,7 +94,6 @@ class Record:
 
     def get_relation_count(self):
         from models.database import Database
-        from models.table import Table
         from models.grid import Grid
 
         # Cache metadata
@@ -107,7 +117,7 @@ class Record:
                 db = Database(self._db.engine, base_name, self._db.user.name)
                 db.indexes
 
-            tbl_rel = Table(db, rel.table_name)
+            tbl_rel = db.table(rel.table_name)
             columns = db.columns[rel.table_name]
             tbl_rel.cols = {col['name']: Dict(col) for col in columns}
 
@@ -151,7 +161,9 @@ class Record:
                     show_if = {rel.referred_columns[i]: col.default}
 
             grid.is_relation = True
-            count_records = grid.get_rowcount() if len(self.pkey) else 0
+            # Exact, as the count is shown and used to find 1:1 records
+            count_records = (grid.get_rowcount(exact=True)
+                             if len(self.pkey) else 0)
 
             relation = Dict({
                 'count_records': count_records,
@@ -423,6 +435,7 @@ class Record:
             sql, inserts = self._db.expr.prepare(sql, inserts)
             crsr.execute(sql, inserts)
             self._db.cnxn.commit()
+        self.invalidate_caches()
 
         return self.pkey
 
@@ -474,6 +487,7 @@ class Record:
             sql, params = self._db.expr.prepare(sql, params)
             crsr.execute(sql, params)
             self._db.cnxn.commit()
+        self.invalidate_caches()
 
         # Update primary key
         for key, value in values.items():
@@ -502,6 +516,7 @@ class Record:
             try:
                 crsr.execute(sql, params)
                 self._db.cnxn.commit()
+                self.invalidate_caches()
                 return 'success'
             except Exception as e:
                 if 'FOREIGN KEY constraint failed' in str(e):
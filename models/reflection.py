@@ -5,15 +5,32 @@ from models.expression import Expression
 
 
 yaml = YAML()
+# Reflected metadata shared between requests, keyed by
+# (host, database, schema)
+metadata = util.Cache(maxsize=64)
+
+
+def get_metadata(engine, schema):
+    """Return shared metadata for schema, to be filled in when loaded"""
+    return metadata.setdefault((engine.host, engine.db_name, schema), Dict())
+
+
+def invalidate_metadata(host, database=None, schema=None):
+    """Remove cached metadata, e.g. after schema changes"""
+    metadata.invalidate(lambda key: key[0] == host and
+                        database in (None, key[1]) and
+                        schema in (None, key[2]))
 
 
 class Reflection:
 
-    def __init__(self, engine, cnxn):
+    def __init__(self, engine, cnxn, cache=None):
         self.cnxn = cnxn
         self.engine = engine
         self.expr = Expression(engine)
         self._fkeys = None
+        # Results for whole schema are kept here
+        self.cache = Dict() if cache is None else cache
 
     def get_version(self):
         sql = self.expr.version()
@@ -24,11 +41,23 @@ class Reflection:
             version = crsr.fetchone()[0]
             return version
 
+    def fingerprint(self, schema):
+        """Return token that changes when the schema is changed"""
+        sql = self.expr.schema_fingerprint()
+        if not sql:
+            return None
+        with self.cnxn.cursor() as crsr:
+            sql, params = self.expr.prepare(sql, {'schema_name': schema})
+            crsr.execute(sql, params)
+            row = crsr.fetchone()
+
+        return ':'.join(str(val) for val in row)
+
     def get_schema_names(self):
         """Get all schemata in database"""
-        if hasattr(self, '_schema_names'):
-            return self._schema_names
-        self._schema_names = []
+        if 'schema_names' in self.cache:
+            return self.cache.schema_names
+        schema_names = []
 
         sql = self.expr.schemata()
         if sql:
@@ -36,15 +65,17 @@ class Reflection:
                 crsr.execute(sql)
                 rows = crsr.fetchall()
                 for row in rows:
-                    self._schema_names.append(row[0])
+                    schema_names.append(row[0])
 
-        return self._schema_names
+        self.cache.schema_names = schema_names
+
+        return schema_names
 
     def tables(self, schema, table=None):
-        if hasattr(self, '_tbl_names'):
-            return self._tbl_names
+        if table is None and 'tables' in self.cache:
+            return self.cache.tables
 
-        self._tables = Dict()
+        tables = Dict()
         with self.cnxn.cursor() as crsr:
             sql = self.expr.user_tables()
             sql, params = self.expr.prepare(sql, {'schema_name': schema,
@@ -52,13 +83,15 @@ class Reflection:
             crsr.execute(sql, params)
             rows = crsr.fetchall()
 
-            for row in rows:
-                rec = util.to_rec(row, crsr, lowercase=True)
-                self._tables[rec.table_name].name = rec.table_name
-                self._tables[rec.table_name].type = rec.table_type.lower()
-                self._tables[rec.table_name].comment = rec.remarks
+            for rec in util.to_recs(rows, crsr, lowercase=True):
+                tables[rec.table_name].name = rec.table_name
+                tables[rec.table_name].type = rec.table_type.lower()
+                tables[rec.table_name].comment = rec.remarks
+
+        if table is None:
+            self.cache.tables = tables
 
-        return self._tables
+        return tables
 
     def pkeys(self, schema, table=None):
         with self.cnxn.cursor() as crsr:
@@ -69,8 +102,8 @@ class Reflection:
             rows = crsr.fetchall()
 
             pkeys = Dict()
-            for row in rows:
-                rec = util.to_rec(row, crsr, lowercase=True)
+            for row, rec in zip(rows, util.to_recs(rows, crsr,
+                                                   lowercase=True)):
                 pkeys[rec.table_name].table_name = rec.table_name
                 pkeys[rec.table_name].pkey_name = rec.pk_name
                 if 'column_names' in rec:
@@ -91,8 +124,9 @@ class Reflection:
 
     def columns(self, schema, table=None):
         """ Return all columns in schema by reflection """
-        # if hasattr(self, '_columns'):
-        #     return self._columns
+        if 'columns' in self.cache:
+            columns = self.cache.columns
+            return columns[table] if table else columns
         with self.cnxn.cursor() as crsr:
             sql = self.expr.columns()
             sql, params = self.expr.prepare(sql, {'schema_name': schema,
@@ -101,8 +135,8 @@ class Reflection:
             rows = crsr.fetchall()
 
             self._columns = Dict()
-            for row in rows:
-                rec = util.to_rec(row, crsr, lowercase=True)
+            for row, rec in zip(rows, util.to_recs(rows, crsr,
+                                                   lowercase=True)):
                 if (type(rec.column_def) is bytes):
                     # default value CURRENT_TIMESTAMP is returned as bytes in mysql
                     rec.column_def = rec.column_def.decode('utf8')
@@ -125,6 +159,9 @@ class Reflection:
                     self._columns[rec.table_name] = []
                 self._columns[rec.table_name].append(col)
 
+        if table is None:
+            self.cache.columns = self._columns
+
         return self._columns[table] if table else self._columns
 
     def fkeys(self, schema, fk_table=None, pk_table=None):
@@ -138,8 +175,7 @@ class Reflection:
             sql, params = self.expr.prepare(self.expr.fkeys(), params)
             crsr.execute(sql, params)
             rows = crsr.fetchall()
-            for row in rows:
-                rec = util.to_rec(row, crsr, lowercase=True)
+            for rec in util.to_recs(rows, crsr, lowercase=True):
                 name = rec.fk_name
                 tblname = rec.fktable_name
                 if 'fkcolumn_names' in rec:
@@ -178,18 +214,7 @@ class Reflection:
         columns = self.columns(schema)
         if fk_table or pk_table is None:
             table_names = [fk_table] if fk_table else self.tables(schema).keys()
-            for fk_tblname in table_names:
-                for fk_col in columns[fk_tblname]:
-                    for pk_tblname in table_names:
-                        if (pk_tblname.rstrip('_') + '_') not in fk_col.name:
-                            continue
-                        for pk_col in columns[pk_tblname]:
-                            if fk_col.name == pk_col.name and fk_tblname == pk_tblname:
-                                continue
-                            fkey = self.fkey_from_colname(fk_col, pk_col,
-                                                          fkeys[fk_tblname])
-                            if fkey:
-                                fkeys[fk_tblname][fkey.name] = fkey
+            self.fkeys_from_colnames(columns, table_names, fkeys)
         else:
             for pk_col in columns[pk_table]:
                 for fk_tbl_name in columns:
@@ -204,6 +229,57 @@ class Reflection:
 
         return all_fkeys if (fk_table is None) else all_fkeys[fk_table]
 
+    def fkeys_from_colnames(self, columns, table_names, fkeys):
+        """Find foreign keys from column names, when none are declared
+
+        A column references another column if its name ends with
+        `<table>_<column>` of the other column, or has the same name,
+        and contains `<table>_`. Candidate columns are found by lookup
+        of the name's suffixes and substrings, instead of comparing
+        with every column in every table. Candidates are handled in
+        table and column order, so the result is the same.
+        """
+        table_names = list(table_names)
+        # Referred columns by `<table>_<column>`
+        by_ref = {}
+        # Referred columns by column name and `<table>_`
+        by_name = {}
+        prefixes = {}
+        for tbl_idx, pk_tblname in enumerate(table_names):
+            prefix = pk_tblname.rstrip('_') + '_'
+            prefixes[tbl_idx] = prefix
+            for col_idx, pk_col in enumerate(columns[pk_tblname]):
+                ref = (pk_tblname + '_' + pk_col.name).replace('__', '_').rstrip('_')
+                by_ref.setdefault(ref, []).append((tbl_idx, col_idx))
+                by_name.setdefault((pk_col.name, prefix), []).append(
+                    (tbl_idx, col_idx))
+
+        for fk_tblname in table_names:
+            for fk_col in columns[fk_tblname]:
+                name = fk_col.name
+                candidates = set()
+                for i in range(len(name)):
+                    for tbl_idx, col_idx in by_ref.get(name[i:], []):
+                        if prefixes[tbl_idx] in name:
+                            candidates.add((tbl_idx, col_idx))
+                # Substrings ending with '_', which may be `<table>_`
+                for end, char in enumerate(name, start=1):
+                    if char != '_':
+                        continue
+                    for start in range(end):
+                        candidates.update(
+                            by_name.get((name, name[start:end]), []))
+
+                for tbl_idx, col_idx in sorted(candidates):
+                    pk_tblname = table_names[tbl_idx]
+                    pk_col = columns[pk_tblname][col_idx]
+                    if name == pk_col.name and fk_tblname == pk_tblname:
+                        continue
+                    fkey = self.fkey_from_colname(fk_col, pk_col,
+                                                  fkeys[fk_tblname])
+                    if fkey:
+                        fkeys[fk_tblname][fkey.name] = fkey
+
     def fkey_from_colname(self, fk_col, pk_col, fkeys):
         fkey = Dict()
         if fk_col.name == pk_col.name and fk_col.table_name == pk_col.table_name:
@@ -242,8 +318,7 @@ class Reflection:
             rows = crsr.fetchall()
 
             indexes = Dict()
-            for row in rows:
-                rec = util.to_rec(row, crsr, lowercase=True)
+            for rec in util.to_recs(rows, crsr, lowercase=True):
                 name = rec.index_name
                 indexes[rec.table_name][name].name = name
                 indexes[rec.table_name][name].unique = not rec.non_unique
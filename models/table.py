@@ -6,7 +6,7 @@ from sqlglot import parse_one, exp
 from settings import Settings
 from models.record import Record
 from models.column import Column
-from models.field import Field
+from models.field import Field, option_lists
 from models.grid import Grid
 from models.expression import Expression
 
@@ -266,7 +266,8 @@ class Table:
             return self._pkey
 
         if self.db.pkeys_loaded:
-            self._pkey = self.db.pkeys[self.name]
+            # Copy, as metadata is shared with other requests
+            self._pkey = self.db.pkeys[self.name].deepcopy()
         else:
             pkey = self.db.refl.pkeys(self.db.schema, self.name)
             self._pkey = Dict({
@@ -345,7 +346,7 @@ class Table:
                                 f'{q(fkey.ref_table_alias)} on {on_list}')
 
             # Join with 1:1 relation carrying access code
-            fkey_table = Table(self.db, fkey.referred_table)
+            fkey_table = self.db.table(fkey.referred_table)
             access_idx = fkey_table.get_access_code_idx()
             if access_idx and access_idx.table_name != fkey_table.name:
                 for key, fkey in fkey_table.relations.items():
@@ -425,7 +426,7 @@ class Table:
 
         # Check if access index is set on extension table
         for key, rel in self.relations.items():
-            rel_table = Table(self.db, rel.table_name)
+            rel_table = self.db.table(rel.table_name)
             prefix = rel.referred_table.rstrip('_') + '_'
             alias = rel.table_name.replace(prefix, '')
 
@@ -510,7 +511,7 @@ class Table:
             self._fkeys = self.db.cache.tables[self.name].fkeys
             return
         if self.db.fkeys_loaded:
-            self._fkeys = self.db.fkeys[self.name]
+            self._fkeys = self.db.fkeys[self.name].deepcopy()
         else:
             fkeys = self.db.refl.fkeys(self.db.schema, fk_table=self.name)
 
@@ -538,14 +539,21 @@ class Table:
         else:
             cols = self.db.refl.columns(self.db.schema, self.name)
 
+        columns = []
         for col in cols:
             col = Dict(col)
-
             column = Column(self, col)
             field = Field(self, col.name)
             field.set_attrs_from_col(column)
+            columns.append((col, column, field))
+
+        counts = self.count_options([field for _, _, field in columns
+                                     if hasattr(field, 'fkey')])
+
+        for col, column, field in columns:
             if hasattr(field, 'fkey'):
-                field.options = field.get_options('', {})
+                field.options = field.get_options('', {},
+                                                  count=counts.get(field.name))
 
             if (
                 field.name in indexed_cols and
@@ -604,13 +612,42 @@ class Table:
 
         self._fields = fields
 
+    def count_options(self, fields):
+        """Count options for fields in one query
+
+        Returns counts by field name, for fields with options
+        not found in cache.
+        """
+        sources = []
+        for field in fields:
+            src = field.options_source()
+            if option_lists.get(field.options_key(src, '1=1', {})) is None:
+                sources.append((field, src))
+        if not sources:
+            return {}
+
+        sql = ' union all '.join(
+            f"select {idx} as idx, {src.select} as cnt "
+            f"from {self.db.schema}.{src.table} {src.alias}"
+            for idx, (field, src) in enumerate(sources)
+        )
+
+        counts = {}
+        with self.db.cnxn.cursor() as crsr:
+            sql, _ = self.db.expr.prepare(sql)
+            crsr.execute(sql)
+            for idx, count in crsr.fetchall():
+                counts[sources[idx][0].name] = count
+
+        return counts
+
     def init_indexes(self):
         """Store Dict of indexes as attribute of table object"""
         if self.db.cache and not self.db.config.update_cache:
             self._indexes = self.db.cache.tables[self.name].indexes
             return
         if self.db.indexes_loaded:
-            self._indexes = self.db.indexes[self.name]
+            self._indexes = self.db.indexes[self.name].deepcopy()
         else:
             indexes = self.db.refl.indexes(self.db.schema, self.name)
             self._indexes = Dict()
@@ -660,13 +697,13 @@ class Table:
                     print(e)
 
         if hasattr(self.db, 'relations') and not self.db.config.update_cache:
-            self._relations = self.db.relations[table_name]
+            self._relations = self.db.relations[table_name].deepcopy()
             return
         if self.db.cache and not self.db.config.update_cache:
             self._relations = self.db.cache.tables[table_name].relations
             return
 
-        relations = self.db.relations[table_name]
+        relations = self.db.relations[table_name].deepcopy()
 
         # find how much the relation is used
         if self.db.config.column_use:
@@ -766,8 +803,9 @@ class Table:
         with self.db.cnxn.cursor() as crsr:
             crsr.execute(sql)
             rows = crsr.fetchall()
+            make_rec = util.row_factory(crsr)
             for row in rows:
-                rec = util.to_rec(row, crsr)
+                rec = make_rec(row)
                 if rec[colname] is None:
                     continue
                 wheres = []
@@ -6,6 +6,17 @@ from models.reflection import Reflection
 from models.expression import Expression
 
 
+# Privileges resolved for a login, keyed by (host, login identity,
+# database, user)
+privileges = util.Cache(maxsize=256, ttl=Settings().privilege_ttl)
+
+
+def invalidate_privileges(engine):
+    """Remove cached privileges for login, e.g. after `set role`"""
+    privileges.invalidate(lambda key: key[:2] == (engine.host,
+                                                  engine.identity))
+
+
 class User:
 
     def __init__(self, engine, cnxn, name=None):
@@ -27,7 +38,7 @@ class User:
             sql, params = self.expr.prepare(sql, params)
             crsr.execute(sql, params)
             rows = crsr.fetchall()
-            recs = [util.to_rec(row, crsr, lowercase=True) for row in rows]
+            recs = util.to_recs(rows, crsr, lowercase=True)
 
         return recs
 
@@ -64,8 +75,9 @@ class User:
                 crsr.execute(sql, params)
                 rows = crsr.fetchall()
 
+                make_rec = util.row_factory(crsr)
                 for row in rows:
-                    rec = util.to_rec(row, crsr)
+                    rec = make_rec(row)
                     tbl_names.remove(rec.table_name)
 
         self._tbl_names = tbl_names
@@ -103,39 +115,83 @@ class User:
 
     @property
     def access_codes(self):
-        if hasattr(self, '_access_codes'):
-            return self._access_codes
         if self.engine.name == 'sqlite':
             db_path = self.engine.url.database
             urdr = 'main' if db_path.endswith('/urdr.db') else 'urdr'
+            return self.get_access_codes(urdr)
+
+    def get_access_codes(self, urdr):
+        """Return access codes of user, including subordinate codes
+
+        Found once for each login, as the recursive query is costly
+        for deep access hierarchies.
+        """
+        if urdr in self.privileges.access_codes:
+            return self.privileges.access_codes[urdr]
+
+        sql = f"""
+        with recursive cte_access (code, parent) as (
+            select a1.code, a1.parent
+            from {urdr}.access a1
+            join {urdr}.user_access ua on ua.access_code = a1.code
+            where ua.user_id = :uid
+            union all
+            select a2.code, a2.parent
+            from {urdr}.access a2
+            join cte_access cte on cte.code = a2.parent
+        )
+        select code from cte_access
+        """
+
+        access_codes = []
+        with self.cnxn.cursor() as crsr:
+            sql, params = self.expr.prepare(sql, {'uid': self.name})
+            crsr.execute(sql, params)
+            rows = crsr.fetchall()
 
-            sql = f"""
-            with recursive cte_access (code, parent) as (
-                select a1.code, a1.parent
-                from {urdr}.access a1
-                join user_access ua on ua.access_code = a1.code
-                where ua.user_id = :uid
-                union all
-                select a2.code, a2.parent
-                from {urdr}.access a2
-                join cte_access cte on cte.code = a2.parent
-            )
-            select code from cte_access
-            """
+        for row in rows:
+            access_codes.append(row[0])
+        self.privileges.access_codes[urdr] = access_codes
 
-            self._access_codes = []
-            with self.cnxn.cursor() as crsr:
-                sql, params = self.expr.prepare(sql, {'uid': self.name})
-                crsr.execute(sql, params)
-                rows = crsr.fetchall()
+        return access_codes
 
-            for row in rows:
-                self._access_codes.append(row[0])
+    @property
+    def privileges(self):
+        """Privileges for this user, shared between requests"""
+        key = (self.engine.host, self.engine.identity, self.engine.db_name,
+               self.name)
+        return privileges.setdefault(key, Dict())
 
-        return self._access_codes
+    @property
+    def grants(self):
+        """Return parsed grants as (object, privileges) in mysql"""
+        if 'grants' in self.privileges:
+            return self.privileges.grants
+
+        grants = []
+        with self.cnxn.cursor() as crsr:
+            sql = 'show grants'
+            crsr.execute(sql)
+            rows = crsr.fetchall()
+        for row in rows:
+            stmt = row[0]
+            grant = re.search(r"^GRANT\s+(.+?)\s+ON\s+(.+?)\s+TO\s+", stmt)
+            if not grant:
+                continue
+            privs = grant.group(1).strip().lower() + ','
+            expr = r'([^,(]+(?:\([^)]+\))?)\s*,\s*'
+            privs = [priv.strip() for priv in re.findall(expr, privs)]
+            obj = grant.group(2).replace('"', '').strip()
+            grants.append((obj, privs))
+        self.privileges.grants = grants
+
+        return grants
 
     def schema_privilege(self, schema):
         """Get user privileges"""
+        if schema in self.privileges.schemas:
+            # Copy, as privileges are shared with other requests
+            return Dict(self.privileges.schemas[schema])
 
         # Set privileges to 0 so that these could be overriden when
         # finding privileges for different database systemes
@@ -180,19 +236,7 @@ class User:
                 privilege.delete = 1
 
         elif self.engine.name in ['mysql', 'mariadb']:
-            with self.cnxn.cursor() as crsr:
-                sql = 'show grants'
-                crsr.execute(sql)
-                rows = crsr.fetchall()
-            for row in rows:
-                stmt = row[0]
-                m = re.search(r"^GRANT\s+(.+?)\s+ON\s+(.+?)\s+TO\s+", stmt)
-                if not m:
-                    continue
-                privs = m.group(1).strip().lower() + ','
-                privs = [priv.strip() for priv in
-                         re.findall(r'([^,(]+(?:\([^)]+\))?)\s*,\s*', privs)]
-                obj = m.group(2).replace('"', '').strip()
+            for obj, privs in self.grants:
                 if obj == schema + '.*' or obj == '*.*':
                     for priv in privilege:
                         if priv in privs or 'all privileges' in privs:
@@ -208,114 +252,73 @@ class User:
             privilege['update'] = 1
             privilege.delete = 1
 
+        self.privileges.schemas[schema] = privilege
         self._privilege = privilege
-        return privilege
+        return Dict(privilege)
 
     def table_privilege(self, schema, table):
         """Return privileges of database user"""
+        if schema not in self.privileges.tables:
+            self.privileges.tables[schema] = self.table_privileges(schema)
+        tables = self.privileges.tables[schema]
+        if table in tables:
+            # Copy, as privileges are shared with other requests
+            return Dict(tables[table])
+
+        return self.schema_privilege(schema)
 
+    def table_privileges(self, schema):
+        """Return privileges for all tables with own privileges
+
+        Found in one go for the schema, to be cached. Other tables
+        have the schema privileges.
+        """
         cfg = Settings()
-        schema_privilege = self.schema_privilege(schema)
-
-        privilege = Dict({
-            'select': schema_privilege.select or 0,
-            'insert': schema_privilege.insert or 0,
-            'update': schema_privilege['update'] or 0,
-            'delete': schema_privilege.delete or 0
-        })
+        tables = Dict()
+
         if self.engine.name == 'sqlite' and cfg.database == 'urdr':
             db_path = self.engine.url.database
             db_name = self.engine.url.database.split(cfg.host)[1].lstrip('/')
             urdr = 'main' if db_path.endswith('/urdr.db') else 'urdr'
             sql = f"""
-            select count(*) from {urdr}.table_access ta
-            where database_name = :db_name and table_name = :table
+            select table_name, read_access, write_access
+            from {urdr}.table_access
+            where database_name = :db_name
             """
             with self.cnxn.cursor() as crsr:
-                sql, params = self.expr.prepare(sql, {'db_name': db_name,
-                                                      'table': table})
+                sql, params = self.expr.prepare(sql, {'db_name': db_name})
                 crsr.execute(sql, params)
-                count = crsr.fetchone()[0]
-            if count:
-                privilege.select = 0
-                privilege.insert = 0
-                privilege['update'] = 0
-                privilege.delete = 0
-
-                sql = f"""
-                with recursive cte_access (code, parent) as (
-                    select a1.code, a1.parent
-                    from {urdr}.access a1
-                    join user_access ua on ua.access_code = a1.code
-                    where ua.user_id = :uid
-                    union all
-                    select a2.code, a2.parent
-                    from {urdr}.access a2
-                    join cte_access cte on cte.code = a2.parent
-                )
-                select count(*) from {urdr}.table_access ta
-                where database_name = :db and table_name = :table and
-                      (read_access is NULL or
-                      read_access in (select code from cte_access))
-                """
-                with self.cnxn.cursor() as crsr:
-                    sql, params = self.expr.prepare(sql, {'uid': self.name,
-                                                          'db': db_name,
-                                                          'table': table})
-                    crsr.execute(sql, params)
-                    count_read = crsr.fetchone()[0]
-
-                sql = f"""
-                with recursive cte_access (code, parent) as (
-                    select a1.code, a1.parent
-                    from {urdr}.access a1
-                    join user_access ua on ua.access_code = a1.code
-                    where ua.user_id = :uid
-                    union all
-                    select a2.code, a2.parent
-                    from {urdr}.access a2
-                    join cte_access cte on cte.code = a2.parent
-                )
-                select count(*) from {urdr}.table_access ta
-                where database_name = :db and table_name = :table and
-                      write_access in (select code from cte_access)
-                """
-                with self.cnxn.cursor() as crsr:
-                    sql, params = self.expr.prepare(sql, {'uid': self.name,
-                                                          'db': db_name,
-                                                          'table': table})
-                    crsr.execute(sql, params)
-                    count_write = crsr.fetchone()[0]
-
-                if count_read:
+                rows = crsr.fetchall()
+
+            for table_name, read_access, write_access in rows:
+                # Access set for table overrides schema privileges
+                if table_name not in tables:
+                    tables[table_name] = Dict({
+                        'select': 0, 'insert': 0, 'update': 0, 'delete': 0
+                    })
+                privilege = tables[table_name]
+                if read_access is None or read_access in self.access_codes:
                     privilege.select = 1
-                if count_write:
+                if write_access in self.access_codes:
                     privilege.insert = 1
                     privilege['update'] = 1
                     privilege.delete = 1
 
         if self.engine.name in ['mysql', 'mariadb']:
-            with self.cnxn.cursor() as crsr:
-                sql = 'show grants'
-                crsr.execute(sql)
-                rows = crsr.fetchall()
-            for row in rows:
-                stmt = row[0]
-                matched = re.search(r"^GRANT\s+(.+?)\s+ON\s+(.+?)\s+TO\s+",
-                                    stmt)
-                if not matched:
+            prefix = schema + '.'
+            for obj, privs in self.grants:
+                if not obj.startswith(prefix):
                     continue
-                privs = matched.group(1).strip().lower() + ','
-                privs = [priv.strip() for priv in
-                         re.findall(r'([^,(]+(?:\([^)]+\))?)\s*,\s*', privs)]
-                obj = matched.group(2).replace('"', '').strip()
-                if obj == schema + '.' + table:
-                    for priv in privilege:
-                        if priv in privs:
-                            privilege[priv] = 1
+                table_name = obj[len(prefix):]
+                if table_name not in tables:
+                    tables[table_name] = self.schema_privilege(schema)
+                privilege = tables[table_name]
+                for priv in privilege:
+                    if priv in privs:
+                        privilege[priv] = 1
         elif self.engine.name == 'postgresql':
             sql = """
-            select privilege_type
+            select table_name, privilege_type
             from information_schema.table_privileges
             where grantee in (
                 WITH RECURSIVE cte AS (
@@ -328,15 +331,18 @@ class User:
                 )
                 SELECT oid::regrole::text AS rolename FROM cte
             )
-            and table_schema = :schema
-            and table_name = :table;
+            and table_schema = :schema;
             """
-            sql, params = self.expr.prepare(sql, {'schema': schema, 'table': table})
+            sql, params = self.expr.prepare(sql, {'schema': schema})
             with self.cnxn.cursor() as crsr:
                 crsr.execute(sql, params)
                 rows = crsr.fetchall()
+                make_rec = util.row_factory(crsr)
                 for row in rows:
-                    rec = util.to_rec(row, crsr)
+                    rec = make_rec(row)
+                    if rec.table_name not in tables:
+                        tables[rec.table_name] = self.schema_privilege(schema)
+                    privilege = tables[rec.table_name]
                     if rec.privilege_type == 'SELECT':
                         privilege.select = 1
                     elif rec.privilege_type == 'INSERT':
@@ -346,30 +352,21 @@ class User:
                     elif rec.privilege_type == 'DELETE':
                         privilege.delete = 1
 
-        return privilege
+        return tables
 
     def is_admin(self, schema):
         if schema in self._is_admin:
             return self._is_admin[schema]
+        if schema in self.privileges.admin:
+            self._is_admin[schema] = self.privileges.admin[schema]
+            return self._is_admin[schema]
         self._is_admin[schema] = False
 
         cfg = Settings()
         if self.engine.name == 'sqlite' and cfg.database == 'urdr':
             return 'sysadmin' in self.access_codes
         elif self.engine.name in ['mysql', 'mariadb']:
-            with self.cnxn.cursor() as crsr:
-                sql = 'show grants'
-                crsr.execute(sql)
-                rows = crsr.fetchall()
-            for row in rows:
-                stmt = row[0]
-                grant = re.search(r"^GRANT\s+(.+?)\s+ON\s+(.+?)\s+TO\s+", stmt)
-                if not grant:
-                    continue
-                privs = grant.group(1).strip().lower() + ','
-                expr = r'([^,(]+(?:\([^)]+\))?)\s*,\s*'
-                privs = [priv.strip() for priv in re.findall(expr, privs)]
-                obj = grant.group(2).replace('"', '').strip()
+            for obj, privs in self.grants:
                 if obj == schema + '.*' or obj == '*.*':
                     if 'all privileges' in privs:
                         self._is_admin[schema] = True
@@ -402,4 +399,5 @@ class User:
         else:
             self._is_admin[schema] = True
 
+        self.privileges.admin[schema] = self._is_admin[schema]
         return self._is_admin[schema]
@@ -31,6 +31,31 @@ class Settings(BaseSettings):
     pwd: str | None = None
     driver: str | None = None
     max_connections: int = 10
+    # Connection pool per database
+    pool_size: int = 5  # max idle connections kept in pool
+    pool_min_size: int = 1  # connections never closed for being idle
+    pool_max_overflow: int = 5  # extra connections allowed under load
+    pool_timeout: int = 30  # seconds to wait for a free connection
+    pool_recycle: int = 60 * 60  # max lifetime of connection in seconds
+    pool_idle_timeout: int = 10 * 60  # close connections idle this long
+    pool_pre_ping: bool = True  # validate connection on checkout
+    login_ttl: int = 5 * 60  # seconds a verified urdr login is cached
+    privilege_ttl: int = 60  # seconds user privileges are cached
+    # Access codes bound as params, instead of found recursively in query
+    max_access_params: int = 500
+    options_ttl: int = 60  # seconds options for fields are cached
+    # Seconds between checks for schema changes in cached metadata
+    metadata_check_interval: int = 5
+    # Connections used concurrently when reflecting schema
+    reflection_workers: int = 4
+    # Connections used concurrently when updating cache
+    cache_workers: int = 4
+    # Rows counted in filtered grids, and smallest estimated count used
+    count_limit: int = 1000
+    grid_ttl: int = 30  # seconds grid responses are cached
+    sums_ttl: int = 300  # seconds footer sums and child counts are cached
+    # Count children in whole table once, for very large hierarchies
+    cache_child_counts: bool = False
     norwegian_chars: bool = False
     exportdir: str | None = None
     websocket: str | None = None
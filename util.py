@@ -1,6 +1,9 @@
 import time
 import inspect
+import threading
+from collections import OrderedDict
 from functools import wraps
+import msgspec
 from settings import Settings
 from addict import Dict
 
@@ -31,7 +34,87 @@ def time_stream_generator(func):
     return wrapper
 
 
-def to_rec(row, crsr, lowercase=False):
+class Cache:
+    """Thread safe LRU cache with optional time to live in seconds"""
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                value, expires = self._data[key]
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, self.ttl if ttl is None else ttl)
+
+    def _store(self, key, value, ttl):
+        """Insert value and evict oldest keys. Caller holds the lock"""
+        expires = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get_or_set(self, key, func):
+        """Return cached value, or call `func` and cache the result
+
+        `func` is called without holding the lock, so concurrent misses
+        may both call it. The last result is kept.
+        """
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def setdefault(self, key, default):
+        """Return cached value, or cache and return `default`"""
+        with self._lock:
+            if key in self._data:
+                value, expires = self._data[key]
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            self._store(key, default, self.ttl)
+            return default
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def invalidate(self, predicate=None):
+        """Remove keys matching `predicate`, or all keys"""
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                return
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+
+def column_names(crsr, lowercase=False):
+    """Return column names from cursor description"""
     # Fixes additional characters at end of column names
     # This happens with special unicode characters in column name
     cols = [col[0] if '\x00' not in col[0]
@@ -39,7 +122,109 @@ def to_rec(row, crsr, lowercase=False):
             for col in crsr.description]
     if lowercase:
         cols = [col.lower() for col in cols]
-    return Dict(zip(cols, row))
+    return cols
+
+
+def to_rec(row, crsr, lowercase=False):
+    return Dict(zip(column_names(crsr, lowercase), row))
+
+
+def to_recs(rows, crsr, lowercase=False):
+    """Return rows as records, reading column names only once"""
+    cols = column_names(crsr, lowercase)
+    return [Dict(zip(cols, row)) for row in rows]
+
+
+class Row:
+    """Read only row with values accessed by column name
+
+    Rows from the same query share the index of column names, so
+    they are cheap to make. Use `to_rec` for records to be changed
+    or returned to the client.
+    """
+
+    __slots__ = ('_values', '_index')
+
+    def __init__(self, values, index):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __getattr__(self, key):
+        try:
+            return self._values[self._index[key]]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return [self._values[i] for i in self._index.values()]
+
+    def items(self):
+        return [(key, self._values[i]) for key, i in self._index.items()]
+
+    def __repr__(self):
+        return f'Row({dict(self.items())!r})'
+
+
+def row_factory(crsr, lowercase=False):
+    """Return function making `Row` objects of rows fetched by cursor
+
+    Must be called after the query is executed. Column names are
+    read from the cursor only once.
+    """
+    cols = column_names(crsr, lowercase)
+    index = {col: i for i, col in enumerate(cols)}
+    return lambda row: Row(row, index)
+
+
+def _enc_hook(obj):
+    """Encode objects msgspec doesn't support natively"""
+    if isinstance(obj, dict):
+        return dict(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+# Decimals, dates and bytes are encoded natively by msgspec
+json_encoder = msgspec.json.Encoder(enc_hook=_enc_hook,
+                                    decimal_format='number')
+msgpack_encoder = msgspec.msgpack.Encoder(enc_hook=_enc_hook,
+                                          decimal_format='number')
+json_decoder = msgspec.json.Decoder()
+
+MSGPACK = 'application/x-msgpack'
+JSON = 'application/json'
+
+
+def encode(obj, media_type=JSON):
+    """Return `obj` encoded as MessagePack or JSON bytes"""
+    if media_type == MSGPACK:
+        return msgpack_encoder.encode(obj)
+    return json_encoder.encode(obj)
+
+
+def decode_json(data):
+    """Return objects from JSON, much faster than the json module"""
+    return json_decoder.decode(data)
 
 
 def format_fkey(fkey, pkey):